@@ -0,0 +1,188 @@
+"""Write-behind batching for upvote/save/complete toggles.
+
+With ACTION_WRITE_BEHIND=1 a toggle only records the user's new desired
+state in memory; one writer thread per process flushes everything pending
+every FLUSH_INTERVAL_MS in a single transaction. Toggling the same kata
+back and forth before a flush coalesces into nothing. Until a flush lands,
+the pending states and counter deltas are overlaid on what the database
+says, so the clicking user sees their own writes.
+
+The overlay is per process: another worker only sees the change once it
+has been flushed, a few milliseconds later.
+"""
+import atexit
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+ACTION_WRITE_BEHIND = os.environ.get('ACTION_WRITE_BEHIND', '') not in ('', '0')
+FLUSH_INTERVAL_MS = int(os.environ.get('ACTION_FLUSH_INTERVAL_MS', 5))
+RETRY_DELAY = 0.1
+
+
+class ActionWriter:
+    def __init__(self, connect, counters, flush_interval_ms=FLUSH_INTERVAL_MS):
+        self._connect = connect
+        self._counters = counters  # action -> katas counter column
+        self._interval = flush_interval_ms / 1000
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # (kata_id, action) -> {user_id: (stored_active, desired_active)}
+        self._pending = {}
+        self._flushing = {}
+        self._thread = None
+        self._pid = None
+        self.flushes = self.flushed_toggles = self.coalesced = 0
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork; start one per process on first use
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending, self._flushing = {}, {}
+            self._thread = threading.Thread(target=self._run, name='action-writer', daemon=True)
+            self._thread.start()
+
+    def _state(self, kata_id, action, user_id):
+        for layer in (self._pending, self._flushing):
+            entry = layer.get((kata_id, action), {}).get(user_id)
+            if entry is not None:
+                return entry[1]
+        return None
+
+    def _delta(self, kata_id, action):
+        return sum(int(desired) - int(stored)
+                   for layer in (self._pending, self._flushing)
+                   for stored, desired in layer.get((kata_id, action), {}).values())
+
+    def toggle(self, user_id, kata_id, action, read_stored):
+        """Queue the flip of one action; return the (active, count) the user should now see.
+
+        `read_stored()` returns the stored (active, count), or None when the
+        kata doesn't exist (then so does this). It runs outside the lock and
+        is retried when a flush commits meanwhile: the flushed state has left
+        the overlay by then, and flipping the older read would lose the click.
+        """
+        while True:
+            with self._lock:
+                self._ensure_thread()
+                generation = self.flushes
+            stored = read_stored()
+            if stored is None:
+                return None
+            with self._lock:
+                if self.flushes == generation:
+                    return self._queue(user_id, kata_id, action, *stored)
+
+    def _queue(self, user_id, kata_id, action, stored_active, stored_count):
+        # Called with the lock held
+        current = self._state(kata_id, action, user_id)
+        active = not (stored_active if current is None else current)
+        users = self._pending.setdefault((kata_id, action), {})
+        if user_id in users:
+            stored = users[user_id][0]
+        else:
+            flushing = self._flushing.get((kata_id, action), {}).get(user_id)
+            stored = flushing[1] if flushing else stored_active
+        if active == stored:
+            # Toggled back before the flush: nothing left to write
+            del users[user_id]
+            if not users:
+                del self._pending[(kata_id, action)]
+            self.coalesced += 1
+        else:
+            users[user_id] = (stored, active)
+        count = stored_count + self._delta(kata_id, action)
+        self._wakeup.notify()
+        return active, count
+
+    def overlay(self, katas, user_id, flags):
+        """Apply pending toggles to hydrated kata dicts (counters for everyone, flags for `user_id`)."""
+        with self._lock:
+            if not (self._pending or self._flushing):
+                return
+            for kata in katas:
+                for action, counter in self._counters.items():
+                    delta = self._delta(kata['id'], action)
+                    if delta:
+                        kata[counter] = (kata[counter] or 0) + delta
+                    if user_id is not None:
+                        state = self._state(kata['id'], action, user_id)
+                        if state is not None:
+                            kata[flags[action]] = state
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            with self._lock:
+                while not self._pending and not self._flushing:
+                    self._wakeup.wait()
+            # Let a few more clicks arrive so they share the transaction
+            time.sleep(self._interval)
+            with self._lock:
+                if not self._flushing:
+                    self._flushing, self._pending = self._pending, {}
+            try:
+                self._flush(conn)
+            except Exception as exc:
+                # Whatever went wrong, the thread must live on or every later toggle stays in memory
+                print(f"Action flush failed, retrying: {exc!r}")
+                if not isinstance(exc, sqlite3.Error):
+                    traceback.print_exc()
+                if conn.in_transaction:
+                    conn.rollback()
+                time.sleep(RETRY_DELAY)
+
+    def _flush(self, conn):
+        batch = self._flushing
+        inserts, deletes = [], []
+        for (kata_id, action), users in batch.items():
+            for user_id, (_, desired) in users.items():
+                (inserts if desired else deletes).append((user_id, kata_id, action))
+
+        cursor = conn.cursor()
+        counter_deltas = {}
+        cursor.execute("BEGIN IMMEDIATE")
+        # Counters follow what actually changed, not what the overlay assumed
+        for row in inserts:
+            cursor.execute("INSERT OR IGNORE INTO user_kata_actions (user_id, kata_id, action_type) VALUES (?, ?, ?)", row)
+            if cursor.rowcount:
+                counter_deltas[(row[1], row[2])] = counter_deltas.get((row[1], row[2]), 0) + 1
+        for row in deletes:
+            cursor.execute("DELETE FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = ?", row)
+            if cursor.rowcount:
+                counter_deltas[(row[1], row[2])] = counter_deltas.get((row[1], row[2]), 0) - 1
+        for (kata_id, action), delta in counter_deltas.items():
+            if delta:
+                counter = self._counters[action]
+                cursor.execute(f"UPDATE katas SET {counter} = {counter} + ? WHERE id = ?", (delta, kata_id))
+        with self._lock:
+            conn.commit()
+            self._flushing = {}
+            self.flushes += 1
+            self.flushed_toggles += len(inserts) + len(deletes)
+
+    def flush_now(self, timeout=5):
+        """Block until everything queued so far has been written (used at exit)."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive() or not (self._pending or self._flushing):
+                    return
+                self._wakeup.notify()
+            time.sleep(self._interval)
+
+    def stats(self):
+        with self._lock:
+            pending = sum(len(users) for users in self._pending.values())
+            return {'enabled': True, 'pending': pending, 'flushes': self.flushes,
+                    'flushed_toggles': self.flushed_toggles, 'coalesced': self.coalesced}
+
+
+def create_writer(connect, counters):
+    if not ACTION_WRITE_BEHIND:
+        return None
+    writer = ActionWriter(connect, counters)
+    atexit.register(writer.flush_now)
+    return writer
@@ -8,30 +8,101 @@
 #     "markdown2",
 # ]
 # ///
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, render_template_string, make_response
-import markdown2
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, make_response, stream_with_context
 import uuid
 import re
-from database import get_db, init_db, DATABASE
+from database import get_db, get_pool, init_db, release_db, connect, rebuild_search_index, DATABASE, READ_ONLY
+from suggest import suggestions
+from page_cache import page_cache
+import action_writer
+import metrics
+import similar
+from search import RELEVANCE_SQL, fts_query, snippets
+from prompts import (ALLOWED_COMPLETION_TIMES, ALLOWED_DIFFICULTIES, build_kata_export_payload, compile_prompt_text,
+                     recent_kata_ids, recent_kata_values, SCHEMA_DETAILS_PATH)
+import dedup
 import os
 import sqlite3
 import json
-from datetime import datetime, timedelta
-from functools import wraps
+import hashlib
+import base64
+import itertools
+import threading
+import csv
+import io
+import zlib
+import click
+from html import escape as html_escape
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from jinja2 import FileSystemBytecodeCache
 
 KATAS_PER_PAGE = 25
-ALLOWED_COMPLETION_TIMES = ['<10 mins', '<30 mins', '<1 hr', '>1 hr']
-ALLOWED_DIFFICULTIES = ['easy', 'medium', 'hard']
 MAX_NOTE_LENGTH = 200
-
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-SCHEMA_DETAILS_PATH = os.path.join(BASE_DIR, 'static', 'kata_schema.txt')
-try:
-    with open(SCHEMA_DETAILS_PATH, 'r', encoding='utf-8') as schema_file:
-        SCHEMA_DETAILS_DESCRIPTION = schema_file.read().strip()
-except FileNotFoundError:
+# Listing sort options and the katas column each one orders by
+SORT_COLUMNS = {'created_at': 'created_at', 'upvotes': 'upvotes', 'saves': 'saves'}
+# Per-user kata actions: the katas counter each one maintains, the flag
+# hydrate_katas sets for it, and its button
+KATA_ACTIONS = {
+    'upvote': {'counter': 'upvotes', 'flag': 'is_upvoted', 'endpoint': 'upvote_kata', 'label': 'Upvote', 'active_label': 'Upvoted'},
+    'save': {'counter': 'saves', 'flag': 'is_saved', 'endpoint': 'save_kata', 'label': 'Save', 'active_label': 'Saved'},
+    'complete': {'counter': 'completions', 'flag': 'is_completed', 'endpoint': 'complete_kata', 'label': 'Complete', 'active_label': 'Completed'},
+}
+# Logged-in listings show unstarted katas first, then saved, then completed.
+# Each tier is its own index-ordered query filtered by a per-user id set that
+# SQLite materializes once, rather than ranking every kata with subqueries.
+PERSONAL_TIERS = [
+    (0, "k.id NOT IN (SELECT kata_id FROM user_kata_actions WHERE user_id = ? AND action_type IN ('save', 'complete'))"),
+    (1, "k.id IN (SELECT kata_id FROM user_kata_actions WHERE user_id = ? AND action_type = 'save') "
+        "AND k.id NOT IN (SELECT kata_id FROM user_kata_actions WHERE user_id = ? AND action_type = 'complete')"),
+    (2, "k.id IN (SELECT kata_id FROM user_kata_actions WHERE user_id = ? AND action_type = 'complete')"),
+]
+PERSONAL_RANKS = tuple(rank for rank, _ in PERSONAL_TIERS)
+# The query parameters the listing reads; anything else doesn't change the page
+INDEX_QUERY_PARAMS = ('difficulty', 'completion_time', 'topic', 'created_at', 'sort_by', 'search', 'after', 'before')
+# Topic facets shown next to the listing, and how many filter combinations keep theirs cached
+FACET_PARAMS = ('difficulty', 'completion_time', 'topic', 'created_at', 'search')
+FACET_TOPICS = 15
+FACET_CACHE_SIZE = 256
+BULK_CHUNK_SIZE = 500
+MAX_REPORTED_ERRORS = 20
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 2))
+STALE_JOB_MINUTES = 10
+# Add Server-Timing headers with each response's SQL and total time
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '') not in ('', '0')
+# When set, /metrics and /cache_stats require "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+EXPORT_BATCH_SIZE = 500
+EXPORT_FORMATS = {'anki': 'tsv', 'csv': 'csv', 'jsonl': 'jsonl'}
+EXPORT_SOURCES = ('saved', 'completed', 'authored', 'filter')
+# Read API: selectable fields (topics come from a batched lookup) and page sizes
+API_FIELDS = {'id': 'k.id', 'title': 'k.title', 'content': 'k.content', 'difficulty': 'k.difficulty',
+              'completion_time': 'k.completion_time', 'topics': None, 'author': 'u.display_name',
+              'created_at': 'k.created_at', 'upvotes': 'k.upvotes', 'saves': 'k.saves', 'completions': 'k.completions'}
+API_DEFAULT_FIELDS = tuple(field for field in API_FIELDS if field != 'content')
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+API_MAX_IDS = 1000
+# Bump when the user identity stored in the session changes shape
+SESSION_USER_VERSION = 2
+USER_CACHE_SIZE = 4096
+# Bump whenever the markdown extras or post-processing change so stored HTML is regenerated
+RENDERER_VERSION = 1
+# Bump whenever page templates change so clients drop their cached copies
+TEMPLATE_VERSION = 1
+# How long a shared proxy may serve an anonymous page without revalidating
+SHARED_CACHE_MAX_AGE = 30
+
+# Bulk uploads are spooled next to the database until a job worker imports them
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.abspath(DATABASE)), 'uploads')
+# Only checked here; the placeholder reads it on first use
+if not os.path.exists(SCHEMA_DETAILS_PATH):
     print("Error: 'static/kata_schema.txt' not found.")
     exit(1)
+# When set, compiled templates are kept in this directory, so a fresh
+# process loads bytecode instead of parsing and compiling every template
+JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR')
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'supersecretkey') # Load from .env or use default
@@ -39,6 +110,13 @@ if not app.secret_key:
     print("Error: SECRET_KEY not set.")
     exit(1)
 
+app.jinja_env.globals['kata_actions'] = KATA_ACTIONS
+if JINJA_CACHE_DIR:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+# Set when ACTION_WRITE_BEHIND is on: toggles are then queued and flushed in batches
+action_writes = action_writer.create_writer(connect, {action: spec['counter'] for action, spec in KATA_ACTIONS.items()})
+
 @app.template_filter('humanize_time')
 def humanize_time(dt):
     if isinstance(dt, str):
@@ -59,35 +137,102 @@ def humanize_time(dt):
     else:
         return 'last year'
 
-# Initialize the database when the app starts
+# Initialize the database when the app starts (once, in the master, when
+# preloaded through wsgi.py); a current schema costs a single read
 with app.app_context():
     init_db()
 
-# Function to close the database connection at the end of the request
+@app.before_request
+def start_request_metrics():
+    g._metrics, g._metrics_token = metrics.start_request()
+
+@app.after_request
+def record_request_metrics(response):
+    stats = g.get('_metrics')
+    if stats is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    elapsed = metrics.registry.record_request(route, request.method, response.status_code, stats)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = (f'sql;dur={stats.sql_seconds * 1000:.2f};desc="{stats.queries} queries", '
+                                             f'total;dur={elapsed * 1000:.2f}')
+    return response
+
+@app.before_request
+def reject_writes_when_read_only():
+    # delete_account is a GET, but it writes
+    if READ_ONLY and (request.method not in ('GET', 'HEAD', 'OPTIONS') or request.endpoint == 'delete_account'):
+        response = jsonify({'success': False, 'message': 'This server is read-only right now.'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '60'
+        return response
+
+@app.teardown_request
+def stop_request_metrics(exc):
+    token = g.pop('_metrics_token', None)
+    if token is not None:
+        metrics.end_request(token)
+
+# Function to return the request's database connection to the pool
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        release_db(db)
 
 # Helper function to get the current user from the database
 def get_current_user():
+    """The logged-in user as a dict, resolved at most once per request.
+
+    The session carries the user's id and display name stamped with the
+    accounts generation, which every account deletion or rename bumps, so
+    most requests never read the users table. When the stamp is stale the
+    user comes from an in-process LRU keyed by that generation, and only
+    then from the database.
+    """
+    if 'current_user' not in g:
+        g.current_user = resolve_current_user()
+    return g.current_user
+
+def resolve_current_user():
     secret_username = session.get('username')
-    if secret_username:
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute("SELECT * FROM users WHERE secret_username = ?", (secret_username,))
-        user = cursor.fetchone()
-        return user
-    return None
+    if not secret_username:
+        return None
+    stamp = [SESSION_USER_VERSION, get_cache_state_row()['accounts_generation']]
+    cached = session.get('user')
+    # The cached identity only counts for the login it was stored under
+    if isinstance(cached, dict) and cached.get('v') == stamp and cached.get('secret_username') == secret_username:
+        return {'id': cached['id'], 'secret_username': secret_username, 'display_name': cached['display_name']}
+
+    try:
+        user = load_user(secret_username, stamp[1])
+    except LookupError:
+        # The account is gone: drop the stale login
+        session.pop('username', None)
+        session.pop('user', None)
+        return None
+    session['user'] = {'id': user['id'], 'secret_username': secret_username, 'display_name': user['display_name'], 'v': stamp}
+    return dict(user)
+
+@lru_cache(maxsize=USER_CACHE_SIZE)
+def load_user(secret_username, accounts_generation):
+    """Read a user by secret username; cached per accounts generation, so deletions invalidate it.
+
+    Raises LookupError for unknown users, which lru_cache doesn't remember,
+    so a username registered later is still found.
+    """
+    cursor = get_db().cursor()
+    cursor.execute("SELECT id, secret_username, display_name FROM users WHERE secret_username = ?", (secret_username,))
+    row = cursor.fetchone()
+    if row is None:
+        raise LookupError(secret_username)
+    return dict(row)
 
 def login_required(response_type='redirect', message=None, flash_category='error'):
     def decorator(view_func):
         @wraps(view_func)
         def wrapped(*args, **kwargs):
-            user = get_current_user()
-            if user:
-                g.current_user = user
+            if get_current_user():
                 return view_func(*args, **kwargs)
 
             if response_type == 'json':
@@ -107,32 +252,77 @@ def get_kata_by_id(kata_id, user_id=None):
     cursor.execute("SELECT k.*, u.display_name as author_display_name FROM katas k JOIN users u ON k.author_id = u.id WHERE k.id = ?", (int(kata_id),))
     kata = cursor.fetchone()
     if kata:
-        # Fetch topics for the kata
-        cursor.execute("SELECT t.name FROM topics t JOIN kata_topics kt ON t.id = kt.topic_id WHERE kt.kata_id = ?", (kata_id,))
-        topics = [row['name'] for row in cursor.fetchall()]
-        kata_dict = dict(kata)
-        kata_dict['topics'] = topics
-        kata_dict['author_display_name'] = kata['author_display_name']
+        return hydrate_katas([kata], user_id, include_notes=True)[0]
+    return None
+
+def get_topics_by_kata(cursor, kata_ids):
+    """Map each kata id in the JSON array `kata_ids` to its topic names, in one query."""
+    topics_by_kata = {}
+    cursor.execute("SELECT kt.kata_id, t.name FROM kata_topics kt JOIN topics t ON t.id = kt.topic_id WHERE kt.kata_id IN (SELECT value FROM json_each(?))", (kata_ids,))
+    for row in cursor.fetchall():
+        topics_by_kata.setdefault(row['kata_id'], []).append(row['name'])
+    return topics_by_kata
 
+def hydrate_katas(katas_data, user_id=None, include_notes=False):
+    """Turn kata rows into dicts with their topics and the user's action flags.
+
+    Runs a fixed number of set-based queries no matter how many rows are passed.
+    """
+    katas_list = [dict(kata_row) for kata_row in katas_data]
+    if not katas_list:
+        return katas_list
+
+    db = get_db()
+    cursor = db.cursor()
+    # A single JSON array parameter keeps the statement text fixed for any list size
+    kata_ids = json.dumps([kata['id'] for kata in katas_list])
+
+    topics_by_kata = get_topics_by_kata(cursor, kata_ids)
+
+    actions_by_kata = {}
+    notes_by_kata = {}
+    if user_id:
+        cursor.execute("SELECT kata_id, action_type FROM user_kata_actions WHERE user_id = ? AND kata_id IN (SELECT value FROM json_each(?))", (user_id, kata_ids))
+        for row in cursor.fetchall():
+            actions_by_kata.setdefault(row['kata_id'], set()).add(row['action_type'])
+        if include_notes:
+            cursor.execute("SELECT kata_id, content FROM user_kata_notes WHERE user_id = ? AND kata_id IN (SELECT value FROM json_each(?))", (user_id, kata_ids))
+            notes_by_kata = {row['kata_id']: row['content'] for row in cursor.fetchall()}
+
+    for kata in katas_list:
+        kata['topics'] = topics_by_kata.get(kata['id'], [])
         if user_id:
-            cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'upvote'", (user_id, kata_id))
-            kata_dict['is_upvoted'] = cursor.fetchone() is not None
-            cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'save'", (user_id, kata_id))
-            kata_dict['is_saved'] = cursor.fetchone() is not None
-            cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'complete'", (user_id, kata_id))
-            kata_dict['is_completed'] = cursor.fetchone() is not None
-            cursor.execute("SELECT content FROM user_kata_notes WHERE user_id = ? AND kata_id = ?", (user_id, kata_id))
-            note_row = cursor.fetchone()
-            if note_row:
-                note_value = note_row['content'] if 'content' in note_row.keys() else note_row[0]
-                kata_dict['user_note'] = note_value
-            else:
-                kata_dict['user_note'] = None
-        else:
-            kata_dict['user_note'] = None
+            kata_actions = actions_by_kata.get(kata['id'], ())
+            kata['is_upvoted'] = 'upvote' in kata_actions
+            kata['is_saved'] = 'save' in kata_actions
+            kata['is_completed'] = 'complete' in kata_actions
+        if include_notes:
+            kata['user_note'] = notes_by_kata.get(kata['id'])
+    if action_writes:
+        action_writes.overlay(katas_list, user_id, {action: spec['flag'] for action, spec in KATA_ACTIONS.items()})
+    return katas_list
 
-        return kata_dict
-    return None
+def kata_html_hash(content):
+    return hashlib.sha256(f"{RENDERER_VERSION}:{content}".encode('utf-8')).hexdigest()
+
+def render_kata_html(content):
+    import markdown2  # Imported on first render: most requests serve stored HTML
+    # Fix for empty LaTeX delimiters
+    content = re.sub(r'\$\$\s*\$\$', '', content)
+    return markdown2.markdown(content, extras=["fenced-code-blocks", "latex"])
+
+def ensure_kata_html(kata):
+    """Fill in kata['html_content'], re-rendering and storing it only if it is stale."""
+    html_hash = kata_html_hash(kata['content'])
+    if kata.get('html_hash') != html_hash or kata.get('html_content') is None:
+        kata['html_content'] = render_kata_html(kata['content'])
+        kata['html_hash'] = html_hash
+        if READ_ONLY:
+            return kata
+        db = get_db()
+        db.execute("UPDATE katas SET html_content = ?, html_hash = ? WHERE id = ?", (kata['html_content'], html_hash, kata['id']))
+        db.commit()
+    return kata
 
 def render_kata_note_section(kata, feedback=None, feedback_type=None, form_value=None, status_message=None):
     return render_template(
@@ -146,86 +336,46 @@ def render_kata_note_section(kata, feedback=None, feedback_type=None, form_value
         status_message=status_message
     )
 
-def build_kata_export_payload(kata, include_user_state=True):
-    payload = {
-        'id': kata.get('id'),
-        'title': kata.get('title'),
-        'content': kata.get('content'),
-        'difficulty': kata.get('difficulty'),
-        'completion_time': kata.get('completion_time'),
-        'topics': kata.get('topics', []),
-        'stats': {
-            'upvotes': kata.get('upvotes'),
-            'saves': kata.get('saves'),
-            'completions': kata.get('completions'),
-        },
-        'author': kata.get('author_display_name'),
-        'created_at': kata.get('created_at'),
-    }
-
-    if include_user_state:
-        note_value = kata.get('user_note') or ''
-        payload['user_state'] = {
-            'is_upvoted': bool(kata.get('is_upvoted')),
-            'is_saved': bool(kata.get('is_saved')),
-            'is_completed': bool(kata.get('is_completed')),
-            'note': note_value,
-        }
-    return payload
-
 @app.route('/autocomplete')
 def autocomplete():
     query = request.args.get('query', '')
     if not query:
         return jsonify([])
 
-    db = get_db()
-    cursor = db.cursor()
-
-    # Search for titles
-    cursor.execute("SELECT id, title FROM katas WHERE title LIKE ? LIMIT 7", ('%' + query + '%',))
-    titles = [{'id': row['id'], 'title': row['title']} for row in cursor.fetchall()]
-
-    # Search for topics
-    cursor.execute("SELECT name FROM topics WHERE name LIKE ? LIMIT 5", ('%' + query + '%',))
-    topics = [row['name'] for row in cursor.fetchall()]
+    # Served from the in-memory prefix index instead of LIKE scans over katas/topics
+    suggestions.sync(get_db())
+    titles, topics = suggestions.search(query)
 
-    return jsonify({'titles': titles, 'topics': topics})
+    response = jsonify({'titles': titles, 'topics': topics})
+    response.cache_control.max_age = 30
+    return response
 
 
-@app.route('/')
-def index():
-    page = request.args.get('page', 1, type=int)
-    user = get_current_user()
-    user_id = user['id'] if user else None
-    
-    db = get_db()
-    cursor = db.cursor()
+def build_kata_filters(args, include_search=True):
+    """Translate the listing filters in `args` into SQL conditions over `katas k`.
 
-    query = "SELECT k.*, u.display_name as author_display_name FROM katas k JOIN users u ON k.author_id = u.id"
+    With include_search=False the caller joins katas_fts itself (to rank by relevance).
+    """
     conditions = []
     params = []
 
-    difficulty_filter = request.args.get('difficulty')
+    difficulty_filter = args.get('difficulty')
     if difficulty_filter:
         conditions.append("k.difficulty = ?")
         params.append(difficulty_filter)
 
-    completion_time_filter = request.args.get('completion_time')
+    completion_time_filter = args.get('completion_time')
     if completion_time_filter:
         conditions.append("k.completion_time = ?")
         params.append(completion_time_filter)
 
-    topic_filter = request.args.get('topic')
+    topic_filter = args.get('topic')
     if topic_filter:
         # Subquery to filter by topic
         conditions.append("k.id IN (SELECT kt.kata_id FROM kata_topics kt JOIN topics t ON kt.topic_id = t.id WHERE t.name = ?)")
         params.append(topic_filter)
 
-    search_query = request.args.get('search')
-    created_at_filter = request.args.get('created_at')
-    sort_by = request.args.get('sort_by', 'created_at') # Default sort by creation date
-
+    created_at_filter = args.get('created_at')
     if created_at_filter:
         now = datetime.now()
         if created_at_filter == 'today':
@@ -244,79 +394,310 @@ def index():
             conditions.append("k.created_at >= ?")
             params.append(start_date)
 
-    if search_query:
-        # Use FTS5 for searching titles and content
+    search_match = fts_query(args.get('search') or '')
+    if search_match and include_search:
+        # Use FTS5 for searching titles, content and topics
         conditions.append("k.id IN (SELECT rowid FROM katas_fts WHERE katas_fts MATCH ?)")
-        params.append(search_query + '*') # Add wildcard for prefix matching
+        params.append(search_match)
 
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
+    return conditions, params
 
-    order_clauses = []
+def encode_cursor(sort_by, key):
+    raw = json.dumps({'s': sort_by, 'k': list(key)}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
 
-    if user_id:
-        order_clauses.append(
-            "CASE "
-            "WHEN EXISTS (SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = k.id AND action_type = 'complete') THEN 2 "
-            "WHEN EXISTS (SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = k.id AND action_type = 'save') THEN 1 "
-            "ELSE 0 END ASC"
-        )
-        params.extend([user_id, user_id])
+def decode_cursor(token, sort_by, key_length):
+    """Return the key stored in a cursor token, or None if it is missing, malformed or for another sort."""
+    if not token:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or data.get('s') != sort_by:
+        return None
+    key = data.get('k')
+    if not isinstance(key, list) or len(key) != key_length:
+        return None
+    return key
+
+def keyset_condition(order, key, forward=True):
+    """SQL predicate for rows strictly after (or, going backwards, before) `key` in `order`.
 
-    if sort_by == 'upvotes':
-        order_clauses.append("k.upvotes DESC")
-    elif sort_by == 'saves':
-        order_clauses.append("k.saves DESC")
+    `order` is a list of (column, descending) pairs ending in a unique column.
+    """
+    if len({descending for _, descending in order}) == 1:
+        # Uniform direction: a row value comparison lets SQLite seek straight to the key
+        op = '<' if order[0][1] == forward else '>'
+        columns = ", ".join(column for column, _ in order)
+        placeholders = ", ".join('?' for _ in order)
+        return f"({columns}) {op} ({placeholders})", list(key)
+
+    clauses = []
+    params = []
+    for i, (column, descending) in enumerate(order):
+        op = '<' if descending == forward else '>'
+        parts = [f"{prev_column} = ?" for prev_column, _ in order[:i]] + [f"{column} {op} ?"]
+        clauses.append("(" + " AND ".join(parts) + ")")
+        params.extend(key[:i + 1])
+    return "(" + " OR ".join(clauses) + ")", params
+
+def order_by_clause(order, forward=True):
+    return ", ".join(f"{column} {'DESC' if descending == forward else 'ASC'}" for column, descending in order)
+
+def make_etag(*parts):
+    return hashlib.sha256(json.dumps([TEMPLATE_VERSION, *parts], default=str).encode('utf-8')).hexdigest()
+
+def get_cache_state_row():
+    """The cache_state counters, read at most once per request."""
+    if '_cache_state' not in g:
+        cursor = get_db().cursor()
+        cursor.execute("SELECT generation, updated_at, accounts_generation FROM cache_state WHERE id = 1")
+        g._cache_state = cursor.fetchone()
+    return g._cache_state
+
+def get_cache_state():
+    """The change counter and last-change time shared by every page's validators."""
+    row = get_cache_state_row()
+    return row['generation'], datetime.fromtimestamp(row['updated_at'], timezone.utc)
+
+def not_modified(etag, last_modified, user):
+    """Return a 304 if the client's copy is current, so the caller can skip hydration and rendering."""
+    if '_flashes' in session:  # Pending messages are rendered into the page
+        return None
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
     else:
-        order_clauses.append("k.created_at DESC")
+        fresh = request.if_modified_since is not None and last_modified <= request.if_modified_since
+    if not fresh:
+        return None
+    return set_cache_headers(app.response_class(status=304), etag, last_modified, user)
 
-    query += " ORDER BY " + ", ".join(order_clauses)
-    
-    # Get total count for pagination
-    count_query = query.replace("SELECT k.*, u.display_name as author_display_name", "SELECT COUNT(k.id)")
-    cursor.execute(count_query, params)
-    total_katas = cursor.fetchone()[0]
+def cached_page(etag, last_modified, user):
+    """Serve an anonymous page straight from the page cache, or None on a miss."""
+    if user or '_flashes' in session:
+        return None
+    body = page_cache.get(etag)
+    if body is None:
+        return None
+    return set_cache_headers(make_response(body), etag, last_modified, user)
+
+def store_page(response, etag, last_modified, user):
+    """Add the caching headers and keep anonymous pages for cached_page."""
+    if not user and not session.modified:
+        page_cache.set(etag, response.get_data())
+    return set_cache_headers(response, etag, last_modified, user)
+
+def set_cache_headers(response, etag, last_modified, user):
+    if session.modified:
+        # The response updates the session cookie (e.g. consumed flashes); never reuse it
+        response.cache_control.no_store = True
+        return response
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    if user:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        # Safe for a shared cache: anonymous pages carry no per-user state, and
+        # Flask adds Vary: Cookie since the session was read
+        response.cache_control.public = True
+        response.cache_control.max_age = 0
+        response.cache_control.s_maxage = SHARED_CACHE_MAX_AGE
+    return response
+
+def get_topic_facets(args):
+    """The most common topics among the katas matching the listing filters in `args`, with counts."""
+    generation, _ = get_cache_state()
+    return topic_facets(tuple((name, args.get(name)) for name in FACET_PARAMS if args.get(name)), generation)
+
+@lru_cache(maxsize=FACET_CACHE_SIZE)
+def topic_facets(filters, generation):
+    # `generation` is only part of the cache key: any write starts a fresh set of entries
+    filters = dict(filters)
+    conditions, params = build_kata_filters(filters)
+    cursor = get_db().cursor()
+    if set(filters) - {'difficulty'} and conditions:
+        cursor.execute(f"""
+            SELECT t.name, COUNT(*) AS katas
+            FROM kata_topics kt JOIN topics t ON t.id = kt.topic_id
+            WHERE kt.kata_id IN (SELECT k.id FROM katas k WHERE {' AND '.join(conditions)})
+            GROUP BY kt.topic_id
+            ORDER BY katas DESC, t.name
+            LIMIT ?
+        """, params + [FACET_TOPICS])
+    else:
+        # All katas, or all of one difficulty: read the maintained counts
+        cursor.execute("SELECT t.name, s.katas FROM topic_stats s JOIN topics t ON t.id = s.topic_id WHERE s.difficulty = ? ORDER BY s.katas DESC LIMIT ?",
+                       (filters.get('difficulty', ''), FACET_TOPICS))
+    return tuple((row['name'], row['katas']) for row in cursor.fetchall())
 
-    print(f"Query: {query}")
-    print(f"Params: {params}")
+@app.route('/')
+def index():
+    user = get_current_user()
+    user_id = user['id'] if user else None
 
-    query += " LIMIT ? OFFSET ?"
-    params.extend([KATAS_PER_PAGE, (page - 1) * KATAS_PER_PAGE])
+    # Searches rank by relevance unless asked otherwise; listings default to newest first
+    search_match = fts_query(request.args.get('search') or '')
+    sort_by = request.args.get('sort_by', 'relevance' if search_match else 'created_at')
+    if sort_by not in SORT_COLUMNS and not (sort_by == 'relevance' and search_match):
+        sort_by = 'created_at'
+    by_relevance = sort_by == 'relevance'
+
+    # Any change to katas or to anyone's actions bumps the generation
+    generation, last_modified = get_cache_state()
+    query_key = [(name, request.args.get(name)) for name in INDEX_QUERY_PARAMS if request.args.get(name) and name != 'sort_by']
+    etag = make_etag('index', generation, sort_by, query_key, user_id, user['display_name'] if user else None)
+    cached = not_modified(etag, last_modified, user) or cached_page(etag, last_modified, user)
+    if cached:
+        return cached
 
-    cursor.execute(query, params)
-    katas_data = cursor.fetchall()
+    db = get_db()
+    cursor = db.cursor()
 
-    paginated_katas = []
+    conditions, params = build_kata_filters(request.args, include_search=not by_relevance)
+    if by_relevance:
+        conditions.insert(0, "katas_fts MATCH ?")
+        params.insert(0, search_match)
 
-    for kata_row in katas_data:
-        kata_dict = dict(kata_row)
-        kata_dict['author_display_name'] = kata_row['author_display_name']
-        # Fetch topics for each kata
-        cursor.execute("SELECT t.name FROM topics t JOIN kata_topics kt ON t.id = kt.topic_id WHERE kt.kata_id = ?", (kata_row['id'],))
-        kata_dict['topics'] = [row['name'] for row in cursor.fetchall()]
+    # bm25() scores are negative, best first
+    sort_order = [('relevance', False), ('id', True)] if by_relevance else [(SORT_COLUMNS[sort_by], True), ('id', True)]
+    order = ([('personal_rank', False)] if user_id else []) + sort_order
 
-        if user_id:
-            cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'upvote'", (user_id, kata_row['id']))
-            kata_dict['is_upvoted'] = cursor.fetchone() is not None
-            cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'save'", (user_id, kata_row['id']))
-            kata_dict['is_saved'] = cursor.fetchone() is not None
-            cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'complete'", (user_id, kata_row['id']))
-            kata_dict['is_completed'] = cursor.fetchone() is not None
+    # Keyset pagination: `after`/`before` carry the sort key of the page edge, so
+    # every page costs the same index seek instead of an ever-growing OFFSET scan.
+    after_key = decode_cursor(request.args.get('after'), sort_by, len(order))
+    before_key = None if after_key else decode_cursor(request.args.get('before'), sort_by, len(order))
+    edge_key = after_key or before_key
+    if user_id and edge_key and edge_key[0] not in PERSONAL_RANKS:
+        edge_key = after_key = before_key = None
+    forward = before_key is None
+
+    if user_id:
+        # Walk the tiers from the page edge onwards (backwards for `before`)
+        edge_rank = edge_key[0] if edge_key else 0
+        tiers = [tier for tier in PERSONAL_TIERS if (tier[0] >= edge_rank if forward else tier[0] <= edge_rank)]
+        if not forward:
+            tiers.reverse()
+    else:
+        tiers = [(None, None)]
+
+    katas_data = []
+    for rank, tier_condition in tiers:
+        select = "k.*, u.display_name as author_display_name"
+        from_clause = "katas k JOIN users u ON k.author_id = u.id"
+        if by_relevance:
+            select += f", {RELEVANCE_SQL} AS relevance"
+            from_clause = "katas_fts JOIN katas k ON k.id = katas_fts.rowid JOIN users u ON k.author_id = u.id"
+        tier_conditions = list(conditions)
+        tier_params = list(params)
+        if rank is not None:
+            select += f", {rank} AS personal_rank"
+            tier_conditions.append(tier_condition)
+            tier_params.extend([user_id] * tier_condition.count('?'))
+
+        inner_query = f"SELECT {select} FROM {from_clause}"
+        if tier_conditions:
+            inner_query += " WHERE " + " AND ".join(tier_conditions)
+        query = f"SELECT * FROM ({inner_query})"
+        if edge_key and (rank is None or rank == edge_key[0]):
+            condition, condition_params = keyset_condition(sort_order, edge_key[-len(sort_order):], forward)
+            query += " WHERE " + condition
+            tier_params.extend(condition_params)
+        query += " ORDER BY " + order_by_clause(sort_order, forward) + " LIMIT ?"
+        tier_params.append(KATAS_PER_PAGE + 1 - len(katas_data))
+
+        cursor.execute(query, tier_params)
+        katas_data.extend(cursor.fetchall())
+        if len(katas_data) > KATAS_PER_PAGE:
+            break
+
+    has_more = len(katas_data) > KATAS_PER_PAGE
+    katas_data = katas_data[:KATAS_PER_PAGE]
+    if forward:
+        has_next, has_prev = has_more, after_key is not None
+    else:
+        katas_data.reverse()
+        has_next, has_prev = True, has_more
 
-        paginated_katas.append(kata_dict)
+    def row_key(kata_row):
+        return [kata_row[column] for column, _ in order]
 
-    total_pages = (total_katas + KATAS_PER_PAGE - 1) // KATAS_PER_PAGE
-    return render_template('index.html', 
+    next_cursor = encode_cursor(sort_by, row_key(katas_data[-1])) if has_next and katas_data else None
+    prev_cursor = encode_cursor(sort_by, row_key(katas_data[0])) if has_prev and katas_data else None
+
+    paginated_katas = hydrate_katas(katas_data, user_id)
+    if search_match and paginated_katas:
+        # Excerpts only for the page being shown, not for every match
+        excerpts = snippets(cursor, search_match, [kata['id'] for kata in paginated_katas])
+        for kata in paginated_katas:
+            kata['search_snippet'] = excerpts.get(kata['id'])
+
+    response = make_response(render_template('index.html', 
                            katas=paginated_katas, 
                            user=user, 
-                           page=page, 
-                           total_pages=total_pages,
-                           current_difficulty=difficulty_filter,
-                           current_completion_time=completion_time_filter,
-                           current_topic=topic_filter,
-                           current_created_at=created_at_filter,
+                           next_cursor=next_cursor,
+                           prev_cursor=prev_cursor,
+                           current_difficulty=request.args.get('difficulty'),
+                           current_completion_time=request.args.get('completion_time'),
+                           current_topic=request.args.get('topic'),
+                           current_created_at=request.args.get('created_at'),
                            sort_by=sort_by,
-                           search_query=search_query)
+                           search_query=request.args.get('search'),
+                           topic_facets=get_topic_facets(request.args)))
+    return store_page(response, etag, last_modified, user)
+
+@app.route('/topics')
+def topics():
+    user = get_current_user()
+    generation, last_modified = get_cache_state()
+    etag = make_etag('topics', generation, user['id'] if user else None, user['display_name'] if user else None)
+    cached = not_modified(etag, last_modified, user) or cached_page(etag, last_modified, user)
+    if cached:
+        return cached
+
+    cursor = get_db().cursor()
+    # One pass over the maintained counts, in name order via the topics name index
+    cursor.execute("SELECT t.name, s.difficulty, s.katas FROM topics t CROSS JOIN topic_stats s ON s.topic_id = t.id ORDER BY t.name")
+    counts_by_topic = {}
+    for row in cursor.fetchall():
+        counts_by_topic.setdefault(row['name'], {})[row['difficulty']] = row['katas']
+    topic_rows = [{'name': name, 'total': counts.get('', 0), 'difficulties': counts} for name, counts in counts_by_topic.items()]
+
+    response = make_response(render_template('topics.html', user=user, topics=topic_rows, difficulties=ALLOWED_DIFFICULTIES))
+    return store_page(response, etag, last_modified, user)
+
+def metrics_authorized():
+    return not METRICS_TOKEN or request.headers.get('Authorization') == f'Bearer {METRICS_TOKEN}'
+
+@app.route('/cache_stats')
+def cache_stats():
+    if not metrics_authorized():
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    return jsonify(page_cache.stats())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics_authorized():
+        return 'Unauthorized', 401
+    cache = page_cache.stats()
+    gauges = [
+        ('app_page_cache_hits', 'Page cache hits in this process.', cache['hits']),
+        ('app_page_cache_misses', 'Page cache misses in this process.', cache['misses']),
+        ('app_page_cache_entries', 'Pages currently cached.', cache['entries']),
+    ]
+    if action_writes:
+        gauges.append(('app_action_writes_pending', 'Toggles waiting for the write-behind flush.', action_writes.stats()['pending']))
+    response = make_response(metrics.registry.render(gauges))
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+@app.route('/metrics/slow_queries')
+def slow_queries():
+    if not metrics_authorized():
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    return jsonify({'threshold_ms': metrics.SLOW_QUERY_MS, 'samples': metrics.registry.slow_query_samples()})
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -328,6 +709,7 @@ def login():
         user = cursor.fetchone()
 
         if user:
+            session.pop('user', None)
             session['username'] = secret_username
             return redirect(url_for('index'))
         else:
@@ -336,6 +718,7 @@ def login():
             if display_name:
                 cursor.execute("INSERT INTO users (secret_username, display_name) VALUES (?, ?)", (secret_username, display_name))
                 db.commit()
+                session.pop('user', None)
                 session['username'] = secret_username
                 flash(f'Welcome! Your secret username is {secret_username}. Please save it for future logins.', 'success')
                 return redirect(url_for('index'))
@@ -346,6 +729,7 @@ def login():
 @app.route('/logout')
 def logout():
     session.pop('username', None)
+    session.pop('user', None)
     return redirect(url_for('index'))
 
 def validate_kata_data(kata_data):
@@ -406,21 +790,31 @@ def submit_kata():
                 flash(error, 'error')
             return redirect(url_for('submit_kata'))
 
+        sig = dedup.signature(title, content)
+        duplicate = dedup.find_duplicate(cursor, sig)
+        if duplicate:
+            cursor.execute("SELECT title FROM katas WHERE id = ?", (duplicate[0],))
+            flash(f"This kata looks like a near-duplicate of \"{cursor.fetchone()['title']}\" (#{duplicate[0]}).", 'error')
+            return redirect(url_for('submit_kata'))
+
         author_id = user['id']
         topics_text = " ".join(topics)
 
-        cursor.execute("INSERT INTO katas (title, content, author_id, difficulty, completion_time, topics_text) VALUES (?, ?, ?, ?, ?, ?)",
-                       (title, content, author_id, difficulty, completion_time, topics_text))
+        cursor.execute("INSERT INTO katas (title, content, author_id, difficulty, completion_time, topics_text, html_content, html_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (title, content, author_id, difficulty, completion_time, topics_text, render_kata_html(content), kata_html_hash(content)))
         kata_id = cursor.lastrowid
         
         # Insert topics and link to kata
-        for topic_name in topics:
-            cursor.execute("INSERT OR IGNORE INTO topics (name) VALUES (?) ", (topic_name,))
-            cursor.execute("SELECT id FROM topics WHERE name = ?", (topic_name,))
-            topic_id = cursor.fetchone()[0]
-            cursor.execute("INSERT INTO kata_topics (kata_id, topic_id) VALUES (?, ?)", (kata_id, topic_id))
+        topic_ids = resolve_topic_ids(cursor, topics)
+        cursor.executemany("INSERT INTO kata_topics (kata_id, topic_id) VALUES (?, ?)",
+                           [(kata_id, topic_ids[topic_name]) for topic_name in dict.fromkeys(topics)])
+        dedup.add_kata(cursor, kata_id, sig)
+        similar.add_katas(db, [kata_id])
 
         db.commit()
+        suggestions.add_kata(kata_id, title)
+        for topic_name in topics:
+            suggestions.add_topic(topic_name)
         flash('Kata submitted successfully!', 'success')
         return redirect(url_for('view_kata', kata_id=kata_id))
     return render_template('submit.html', user=user, allowed_completion_times=ALLOWED_COMPLETION_TIMES, allowed_difficulties=ALLOWED_DIFFICULTIES)
@@ -432,136 +826,98 @@ def preview():
     # Fix for empty LaTeX delimiters
     if re.search(r'\$\$\s*\$\$', content):
         return ""
-    html_content = markdown2.markdown(content, extras=["fenced-code-blocks", "latex"])
-    return html_content
+    return render_kata_html(content)
 
 @app.route('/kata/<int:kata_id>')
 def view_kata(kata_id):
     user = get_current_user()
     user_id = user['id'] if user else None
-    kata = get_kata_by_id(kata_id, user_id)
-    if kata:
-        # Fix for empty LaTeX delimiters
-        if not re.search(r'\$\$\s*\$\$', kata['content']):
-            kata['html_content'] = markdown2.markdown(kata['content'], extras=["fenced-code-blocks", "latex"])
-        else:
-            kata['html_content'] = markdown2.markdown(re.sub(r'\$\$\s*\$\$', '', kata['content']), extras=["fenced-code-blocks", "latex"])
-        kata_export = build_kata_export_payload(kata, include_user_state=bool(user))
-        return render_template('view_kata.html', kata=kata, user=user, note_max_length=MAX_NOTE_LENGTH, kata_export=kata_export)
-    return 'Kata not found', 404
 
-@app.route('/kata/<int:kata_id>/upvote', methods=['POST'])
-@login_required(message='Please log in to upvote katas.')
-def upvote_kata(kata_id):
-    user = g.current_user
+    # Everything the page shows, reduced to one cheap validator row
+    cursor = get_db().cursor()
+    cursor.execute("""
+        SELECT k.title, k.content, k.difficulty, k.completion_time, k.topics_text, k.created_at,
+               k.upvotes, k.saves, k.completions, u.display_name,
+               (SELECT group_concat(neighbor_id) FROM kata_neighbors WHERE kata_id = k.id) AS neighbor_ids,
+               (SELECT group_concat(action_type) FROM user_kata_actions WHERE user_id = ? AND kata_id = k.id) AS actions,
+               (SELECT content FROM user_kata_notes WHERE user_id = ? AND kata_id = k.id) AS note
+        FROM katas k JOIN users u ON k.author_id = u.id
+        WHERE k.id = ?
+    """, (user_id, user_id, kata_id))
+    validator = cursor.fetchone()
+    if validator is None:
+        return 'Kata not found', 404
+    _, last_modified = get_cache_state()
+    etag = make_etag('kata', kata_id, RENDERER_VERSION, tuple(validator),
+                     user_id, user['display_name'] if user else None)
+    cached = not_modified(etag, last_modified, user) or cached_page(etag, last_modified, user)
+    if cached:
+        return cached
 
+    kata = get_kata_by_id(kata_id, user_id)
+    ensure_kata_html(kata)
+    kata_export = build_kata_export_payload(kata, include_user_state=bool(user))
+    similar_katas = similar.get_similar_katas(get_db(), kata_id)
+    response = make_response(render_template('view_kata.html', kata=kata, user=user, note_max_length=MAX_NOTE_LENGTH, kata_export=kata_export, similar_katas=similar_katas))
+    return store_page(response, etag, last_modified, user)
+
+def toggle_kata_action(kata_id, action):
+    """Flip the user's `action` on a kata and return its button fragment.
+
+    Costs two statements: an INSERT OR IGNORE (or, when it already existed, a
+    DELETE) and a counter UPDATE ... RETURNING the new count. With write-behind
+    it costs one read of the stored state, and the flip is queued for the
+    writer thread.
+    """
+    user = g.current_user
+    spec = KATA_ACTIONS[action]
     db = get_db()
     cursor = db.cursor()
-    
-    # Check if already upvoted
-    cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'upvote'", (user['id'], kata_id))
-    already_upvoted = cursor.fetchone()
 
-    if already_upvoted:
-        cursor.execute("DELETE FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'upvote'", (user['id'], kata_id))
-        cursor.execute("UPDATE katas SET upvotes = upvotes - 1 WHERE id = ?", (kata_id,))
-    else:
-        cursor.execute("INSERT INTO user_kata_actions (user_id, kata_id, action_type) VALUES (?, ?, ?)", (user['id'], kata_id, 'upvote'))
-        cursor.execute("UPDATE katas SET upvotes = upvotes + 1 WHERE id = ?", (kata_id,))
+    if action_writes:
+        def read_stored():
+            cursor.execute(f"""
+                SELECT EXISTS (SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = k.id AND action_type = ?),
+                       {spec['counter']}
+                FROM katas k WHERE id = ?
+            """, (user['id'], action, kata_id))
+            row = cursor.fetchone()
+            return (bool(row[0]), row[1]) if row else None
+
+        toggled = action_writes.toggle(user['id'], kata_id, action, read_stored)
+        if toggled is None:
+            return 'Kata not found', 404
+        active, count = toggled
+        return render_template('partials/action_button.html', action=action, kata_id=kata_id, active=active, count=count, user=user)
+
+    cursor.execute("INSERT OR IGNORE INTO user_kata_actions (user_id, kata_id, action_type) VALUES (?, ?, ?)", (user['id'], kata_id, action))
+    active = cursor.rowcount == 1
+    if not active:
+        cursor.execute("DELETE FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = ?", (user['id'], kata_id, action))
+    cursor.execute(f"UPDATE katas SET {spec['counter']} = {spec['counter']} + ? WHERE id = ? RETURNING {spec['counter']}",
+                   (1 if active else -1, kata_id))
+    row = cursor.fetchone()
+    if row is None:
+        db.rollback()
+        return 'Kata not found', 404
     db.commit()
 
-    # Fetch the updated kata data
-    updated_kata = get_kata_by_id(kata_id, user['id'])
-
-    # Render the updated button snippet
-    return render_template_string(
-        """<span id=\"upvote-button-{{ kata.id }}"
-              hx-post=\"{{ url_for('upvote_kata', kata_id=kata.id) }}"
-              hx-target=\"this"
-              hx-swap=\"outerHTML"
-              style=\"display: inline-block;">\n            <button type=\"button\" {% if not user %}disabled{% endif %}>
-                {{ \"Upvoted\" if kata.is_upvoted else \"Upvote\" }} ({{ kata.upvotes }})
-            </button>
-        </span>""",
-        kata=updated_kata, user=user
-    )
+    return render_template('partials/action_button.html', action=action, kata_id=kata_id, active=active, count=row[0], user=user)
 
+@app.route('/kata/<int:kata_id>/upvote', methods=['POST'])
+@login_required(message='Please log in to upvote katas.')
+def upvote_kata(kata_id):
+    return toggle_kata_action(kata_id, 'upvote')
 
 @app.route('/kata/<int:kata_id>/save', methods=['POST'])
 @login_required(message='Please log in to save katas.')
 def save_kata(kata_id):
-    user = g.current_user
-
-    db = get_db()
-    cursor = db.cursor()
-    
-    # Check if already saved
-    cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'save'", (user['id'], kata_id))
-    already_saved = cursor.fetchone()
-
-    if already_saved:
-        cursor.execute("DELETE FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'save'", (user['id'], kata_id))
-        cursor.execute("UPDATE katas SET saves = saves - 1 WHERE id = ?", (kata_id,))
-    else:
-        cursor.execute("INSERT INTO user_kata_actions (user_id, kata_id, action_type) VALUES (?, ?, ?)", (user['id'], kata_id, 'save'))
-        cursor.execute("UPDATE katas SET saves = saves + 1 WHERE id = ?", (kata_id,))
-    db.commit()
-
-    # Fetch the updated kata data
-    updated_kata = get_kata_by_id(kata_id, user['id'])
-
-    # Render the updated button snippet
-    return render_template_string(
-        """<span id=\"save-button-{{ kata.id }}"
-              hx-post=\"{{ url_for('save_kata', kata_id=kata.id) }}"
-              hx-target=\"this"
-              hx-swap=\"outerHTML"
-              style=\"display: inline-block;\">
-            <button type=\"button" {% if not user %}disabled{% endif %}>
-                {{ \"Saved\" if kata.is_saved else \"Save\" }} ({{ kata.saves }})
-            </button>
-        </span>""",
-        kata=updated_kata, user=user
-    )
-
+    return toggle_kata_action(kata_id, 'save')
 
 @app.route('/kata/<int:kata_id>/complete', methods=['POST'])
 @login_required(message='Please log in to mark katas as complete.')
 def complete_kata(kata_id):
-    user = g.current_user
-
-    db = get_db()
-    cursor = db.cursor()
-    
-    # Check if already completed
-    cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'complete'", (user['id'], kata_id))
-    already_completed = cursor.fetchone()
-
-    if already_completed:
-        cursor.execute("DELETE FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'complete'", (user['id'], kata_id))
-        cursor.execute("UPDATE katas SET completions = completions - 1 WHERE id = ?", (kata_id,))
-    else:
-        cursor.execute("INSERT INTO user_kata_actions (user_id, kata_id, action_type) VALUES (?, ?, ?)", (user['id'], kata_id, 'complete'))
-        cursor.execute("UPDATE katas SET completions = completions + 1 WHERE id = ?", (kata_id,))
-    db.commit()
-
-    # Fetch the updated kata data
-    updated_kata = get_kata_by_id(kata_id, user['id'])
-
-    # Render the updated button snippet
-    return render_template_string(
-        """<span id=\"complete-button-{{ kata.id }}"
-              hx-post=\"{{ url_for('complete_kata', kata_id=kata.id) }}"
-              hx-target=\"this"
-              hx-swap=\"outerHTML"
-              style=\"display: inline-block;\">
-            <button type=\"button" {% if not user %}disabled{% endif %}>
-                {{ \"Completed\" if kata.is_completed else \"Complete\" }} ({{ kata.completions }})
-            </button>
-        </span>""",
-        kata=updated_kata, user=user
-    )
-
+    return toggle_kata_action(kata_id, 'complete')
 
 @app.route('/kata/<int:kata_id>/note', methods=['POST'])
 @login_required(response_type='plain', message='Unauthorized')
@@ -632,10 +988,14 @@ def delete_kata(kata_id):
     # Then, delete from kata_topics
     cursor.execute("DELETE FROM kata_topics WHERE kata_id = ?", (kata_id,))
     
+    similar.remove_kata(db, kata_id)
+    dedup.remove_kata(cursor, kata_id)
+
     # Finally, delete the kata itself
     cursor.execute("DELETE FROM katas WHERE id = ?", (kata_id,))
     
     db.commit()
+    suggestions.remove_kata(kata_id)
 
     flash('Kata deleted successfully.', 'success')
     return redirect(url_for('index'))
@@ -645,24 +1005,7 @@ def get_katas_by_action(user_id, action_type):
     cursor = db.cursor()
     cursor.execute("SELECT k.*, u.display_name as author_display_name FROM katas k JOIN user_kata_actions uka ON k.id = uka.kata_id JOIN users u ON k.author_id = u.id WHERE uka.user_id = ? AND uka.action_type = ? ORDER BY uka.timestamp DESC", (user_id, action_type))
     katas_data = cursor.fetchall()
-
-    katas_list = []
-    for kata_row in katas_data:
-        kata_dict = dict(kata_row)
-        kata_dict['author_display_name'] = kata_row['author_display_name']
-        cursor.execute("SELECT t.name FROM topics t JOIN kata_topics kt ON t.id = kt.topic_id WHERE kt.kata_id = ?", (kata_row['id'],))
-        kata_dict['topics'] = [row['name'] for row in cursor.fetchall()]
-
-        # Fetch user action status for saved katas
-        cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'upvote'", (user_id, kata_row['id']))
-        kata_dict['is_upvoted'] = cursor.fetchone() is not None
-        cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'save'", (user_id, kata_row['id']))
-        kata_dict['is_saved'] = cursor.fetchone() is not None
-        cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'complete'", (user_id, kata_row['id']))
-        kata_dict['is_completed'] = cursor.fetchone() is not None
-
-        katas_list.append(kata_dict)
-    return katas_list
+    return hydrate_katas(katas_data, user_id)
 
 def get_katas_by_author(author_id):
     db = get_db()
@@ -670,27 +1013,9 @@ def get_katas_by_author(author_id):
     cursor.execute("SELECT k.*, u.display_name as author_display_name FROM katas k JOIN users u ON k.author_id = u.id WHERE k.author_id = ?", (author_id,))
     katas_data = cursor.fetchall()
 
-    katas_list = []
     user = get_current_user()
     user_id = user['id'] if user else None
-
-    for kata_row in katas_data:
-        kata_dict = dict(kata_row)
-        kata_dict['author_display_name'] = kata_row['author_display_name']
-        cursor.execute("SELECT t.name FROM topics t JOIN kata_topics kt ON t.id = kt.topic_id WHERE kt.kata_id = ?", (kata_row['id'],))
-        kata_dict['topics'] = [row['name'] for row in cursor.fetchall()]
-
-        if user_id:
-            # Fetch user action status for the katas
-            cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'upvote'", (user_id, kata_row['id']))
-            kata_dict['is_upvoted'] = cursor.fetchone() is not None
-            cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'save'", (user_id, kata_row['id']))
-            kata_dict['is_saved'] = cursor.fetchone() is not None
-            cursor.execute("SELECT 1 FROM user_kata_actions WHERE user_id = ? AND kata_id = ? AND action_type = 'complete'", (user_id, kata_row['id']))
-            kata_dict['is_completed'] = cursor.fetchone() is not None
-
-        katas_list.append(kata_dict)
-    return katas_list
+    return hydrate_katas(katas_data, user_id)
 
 @app.route('/saved')
 @login_required(message='Please log in to view your saved katas.')
@@ -716,86 +1041,580 @@ def my_katas():
     my_katas_list = get_katas_by_author(user['id'])
     return render_template('kata_list.html', katas=my_katas_list, user=user, page_title="My Katas")
 
-@app.route('/bulk_upload_katas', methods=['POST'])
-@login_required(message='Please log in to bulk upload katas.')
-def bulk_upload_katas():
-    user = g.current_user
-
-    db = get_db()
-    cursor = db.cursor()
-    uploaded_count = 0
-    errors = []
-
-    json_data_str = request.form.get('json_data')
-    json_file = request.files.get('json_file')
+def export_query(source, user_id, args):
+    """The SQL and params selecting the katas of an export source, in export order."""
+    select = "SELECT k.*, u.display_name as author_display_name FROM katas k JOIN users u ON k.author_id = u.id"
+    if source in ('saved', 'completed'):
+        action = 'save' if source == 'saved' else 'complete'
+        return (select + " JOIN user_kata_actions uka ON k.id = uka.kata_id WHERE uka.user_id = ? AND uka.action_type = ? ORDER BY uka.timestamp DESC",
+                [user_id, action])
+    if source == 'authored':
+        return select + " WHERE k.author_id = ? ORDER BY k.created_at DESC, k.id DESC", [user_id]
+    conditions, params = build_kata_filters(args)
+    if conditions:
+        select += " WHERE " + " AND ".join(conditions)
+    return select + " ORDER BY k.created_at DESC, k.id DESC", params
+
+def export_html(kata):
+    """The kata's stored HTML if current, else a fresh render (exports never write)."""
+    if kata.get('html_content') is not None and kata.get('html_hash') == kata_html_hash(kata['content']):
+        return kata['html_content']
+    return render_kata_html(kata['content'])
+
+def iter_export(source, fmt, user_id=None, args=None):
+    """Yield an export as text chunks, one batch of katas at a time.
+
+    Rows are read from a server-side cursor EXPORT_BATCH_SIZE at a time and
+    hydrated per batch, so memory stays flat however many katas match.
+    """
+    query, params = export_query(source, user_id, args or {})
+    cursor = get_db().cursor()
+    cursor.execute(query, params)
 
-    kata_data_list = []
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter='\t' if fmt == 'anki' else ',', lineterminator='\n')
+    if fmt == 'anki':
+        # Anki (2.1.55+) reads these headers to set up the import
+        buffer.write("#separator:tab\n#html:true\n#columns:Front\tBack\tTags\n#tags column:3\n")
+    elif fmt == 'csv':
+        header = ['id', 'title', 'difficulty', 'completion_time', 'topics', 'author', 'created_at', 'upvotes', 'saves', 'completions', 'content']
+        if user_id:
+            header += ['is_upvoted', 'is_saved', 'is_completed', 'note']
+        writer.writerow(header)
 
-    if json_data_str:
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            break
+        for kata in hydrate_katas(rows, user_id, include_notes=bool(user_id)):
+            payload = build_kata_export_payload(kata, include_user_state=bool(user_id))
+            if fmt == 'jsonl':
+                buffer.write(json.dumps(payload, default=str) + '\n')
+            elif fmt == 'anki':
+                back = export_html(kata)
+                if payload.get('user_state', {}).get('note'):
+                    back += f"<hr><p><em>{html_escape(payload['user_state']['note'])}</em></p>"
+                tags = [re.sub(r'\s+', '_', topic) for topic in payload['topics']] + [f"difficulty::{payload['difficulty']}"]
+                writer.writerow([html_escape(payload['title']), back, ' '.join(tags)])
+            else:
+                row = [payload['id'], payload['title'], payload['difficulty'], payload['completion_time'], ', '.join(payload['topics']),
+                       payload['author'], payload['created_at'], payload['stats']['upvotes'], payload['stats']['saves'],
+                       payload['stats']['completions'], payload['content']]
+                if user_id:
+                    state = payload['user_state']
+                    row += [int(state['is_upvoted']), int(state['is_saved']), int(state['is_completed']), state['note']]
+                writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    for chunk in chunks:
+        # Chunks are whole batches of rows; a sync flush sends each one on instead of
+        # holding it until zlib's buffer fills
+        yield compressor.compress(chunk.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+@app.route('/export')
+def export_katas():
+    source = request.args.get('source', 'saved')
+    fmt = request.args.get('format', 'anki')
+    if source not in EXPORT_SOURCES or fmt not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'message': f"source must be one of {', '.join(EXPORT_SOURCES)} and format one of {', '.join(EXPORT_FORMATS)}."}), 400
+    user = get_current_user()
+    if source != 'filter' and not user:
+        return jsonify({'success': False, 'message': 'Please log in to export your katas.'}), 401
+
+    filename = f"ml-katas-{source}.{EXPORT_FORMATS[fmt]}"
+    chunks = iter_export(source, fmt, user['id'] if user else None, request.args)
+    mimetype = {'anki': 'text/tab-separated-values', 'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}[fmt]
+    if request.args.get('gzip') in ('1', 'true'):
+        body = gzip_chunks(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    else:
+        body = (chunk.encode('utf-8') for chunk in chunks)
+    response = app.response_class(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.cache_control.no_store = True
+    return response
+
+def parse_api_query(args, streaming):
+    """Validate the read API's parameters; raises ValueError with a message for the client."""
+    fields = [field.strip() for field in args.get('fields', '').split(',') if field.strip()] or list(API_DEFAULT_FIELDS)
+    unknown = [field for field in fields if field not in API_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Choose from {', '.join(API_FIELDS)}.")
+
+    sort_by = args.get('sort_by', 'created_at')
+    if sort_by not in SORT_COLUMNS:
+        raise ValueError(f"sort_by must be one of {', '.join(SORT_COLUMNS)}.")
+
+    ids = None
+    if args.get('ids'):
+        try:
+            ids = [int(value) for value in args['ids'].split(',') if value.strip()]
+        except ValueError:
+            raise ValueError("ids must be a comma-separated list of kata ids.")
+        if len(ids) > API_MAX_IDS:
+            raise ValueError(f"At most {API_MAX_IDS} ids per request.")
+
+    # A page of JSON is built in memory, so it is capped; NDJSON streams everything unless told otherwise
+    limit = args.get('limit', None if streaming else API_PAGE_SIZE)
+    try:
+        limit = None if limit is None else int(limit)
+    except ValueError:
+        limit = 0  # Reported like any other out-of-range limit
+    if limit is not None and (limit < 1 or (not streaming and limit > API_MAX_PAGE_SIZE)):
+        raise ValueError(f"limit must be an integer between 1 and {API_MAX_PAGE_SIZE}." if not streaming else "limit must be a positive integer.")
+
+    after_key = None
+    if args.get('after'):
+        after_key = decode_cursor(args['after'], sort_by, 2)
+        if after_key is None:
+            # Restarting from the first page would loop a client that pages until the end
+            raise ValueError("Invalid cursor for this sort order.")
+    return fields, sort_by, ids, limit, after_key
+
+def api_kata_query(args, fields, sort_by, ids, limit, after_key):
+    """The SQL and params for one API page: only the requested columns, in keyset order."""
+    sort_column = SORT_COLUMNS[sort_by]
+    sort_order = [(sort_column, True), ('id', True)]
+    # The sort key is always selected so the last row can become the next cursor
+    columns = {'id': 'k.id', sort_column: f'k.{sort_column}'}
+    columns.update((field, API_FIELDS[field]) for field in fields if API_FIELDS[field])
+
+    conditions, params = build_kata_filters(args)
+    if ids is not None:
+        conditions.append("k.id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(ids))
+    inner_query = "SELECT " + ", ".join(f"{expr} AS {name}" for name, expr in columns.items()) + " FROM katas k"
+    if 'author' in fields:
+        inner_query += " JOIN users u ON k.author_id = u.id"
+    if conditions:
+        inner_query += " WHERE " + " AND ".join(conditions)
+
+    query = f"SELECT * FROM ({inner_query})"
+    if after_key:
+        condition, condition_params = keyset_condition(sort_order, after_key)
+        query += " WHERE " + condition
+        params.extend(condition_params)
+    # One extra row tells whether there is a next page
+    query += " ORDER BY " + order_by_clause(sort_order) + " LIMIT ?"
+    params.append(-1 if limit is None else limit + 1)
+    return query, params
+
+def iter_api_katas(query, params, fields, sort_by, limit):
+    """Yield ('kata', payload) items, then ('next_cursor', token) if the limit cut the results short."""
+    cursor = get_db().cursor()
+    cursor.execute(query, params)
+    sort_column = SORT_COLUMNS[sort_by]
+    emitted = 0
+    last_row = None
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            return
+        topics_by_kata = {}
+        if 'topics' in fields:
+            topics_by_kata = get_topics_by_kata(get_db().cursor(), json.dumps([row['id'] for row in rows]))
+        for row in rows:
+            if limit is not None and emitted == limit:
+                yield 'next_cursor', encode_cursor(sort_by, [last_row[sort_column], last_row['id']])
+                return
+            yield 'kata', {field: topics_by_kata.get(row['id'], []) if field == 'topics' else row[field] for field in fields}
+            emitted += 1
+            last_row = row
+
+@app.route('/api/v1/katas')
+def api_katas():
+    """Public read API: the index filters plus ids=, fields=, limit= and after= cursors.
+
+    Answers with a JSON page, or with NDJSON (format=ndjson or Accept:
+    application/x-ndjson) streamed in batches, one kata per line and a final
+    {"next_cursor": ...} line if `limit` stopped it early.
+    """
+    streaming = (request.args.get('format') == 'ndjson' or
+                 request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson')
+    try:
+        fields, sort_by, ids, limit, after_key = parse_api_query(request.args, streaming)
+    except ValueError as exc:
+        return jsonify({'success': False, 'message': str(exc)}), 400
+
+    generation, last_modified = get_cache_state()
+    etag = make_etag('api_katas', generation, streaming, sorted(request.args.items(multi=True)))
+    cached = not_modified(etag, last_modified, None)
+    if cached:
+        cached.vary.add('Accept')
+        return cached
+
+    query, params = api_kata_query(request.args, fields, sort_by, ids, limit, after_key)
+    items = iter_api_katas(query, params, fields, sort_by, limit)
+    if streaming:
+        body = (json.dumps({kind: value} if kind == 'next_cursor' else value, default=str) + '\n' for kind, value in items)
+        response = app.response_class(stream_with_context(body), mimetype='application/x-ndjson')
+    else:
+        katas, next_cursor = [], None
+        for kind, value in items:
+            if kind == 'kata':
+                katas.append(value)
+            else:
+                next_cursor = value
+        response = app.response_class(json.dumps({'katas': katas, 'next_cursor': next_cursor}, default=str), mimetype='application/json')
+    response.vary.add('Accept')
+    return set_cache_headers(response, etag, last_modified, None)
+
+def resolve_topic_ids(cursor, topic_names, topic_ids=None):
+    """Map topic names to ids, creating missing topics.
+
+    `topic_ids` is an optional name->id cache that is filled in place, so a
+    long import only looks each topic up once.
+    """
+    if topic_ids is None:
+        topic_ids = {}
+    missing = [name for name in dict.fromkeys(topic_names) if name not in topic_ids]
+    if missing:
+        cursor.executemany("INSERT OR IGNORE INTO topics (name) VALUES (?)", [(name,) for name in missing])
+        cursor.execute("SELECT id, name FROM topics WHERE name IN (SELECT value FROM json_each(?))", (json.dumps(missing),))
+        topic_ids.update((row['name'], row['id']) for row in cursor.fetchall())
+    return topic_ids
+
+def iter_json_array(stream, read_size=64 * 1024):
+    """Yield the items of a top-level JSON array read incrementally from a text stream."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+    state = 'start'  # start -> first item or ']' -> ',' or ']' -> next item -> ...
+
+    while True:
+        # Skip whitespace, reading more input as needed
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            chunk = stream.read(read_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+        if pos >= len(buffer):
+            raise ValueError('Unexpected end of JSON data.')
+
+        char = buffer[pos]
+        if state == 'start':
+            if char != '[':
+                raise ValueError('Expected a JSON array of katas.')
+            pos += 1
+            state = 'first'
+        elif state == 'after_item':
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f"Expected ',' or ']' but found {char!r}.")
+            pos += 1
+            state = 'item'
+        elif state == 'first' and char == ']':
+            return
+        else:
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    end = None
+                # An item ending exactly at the buffer edge may have been cut short
+                if end is not None and (end < len(buffer) or eof):
+                    break
+                chunk = stream.read(read_size)
+                eof = not chunk
+                buffer, pos = buffer[pos:] + chunk, 0
+            yield item
+            pos = end
+            state = 'after_item'
+
+def prepare_bulk_kata(kata_data):
+    """Normalize one uploaded kata and return (row values, topics, validation errors)."""
+    if not isinstance(kata_data, dict):
+        return None, None, ['Each kata must be a JSON object.']
+    topics = kata_data.get('topics', '')
+    if isinstance(topics, str):
+        topics = topics.split(',')
+    topics = [str(t).strip() for t in topics if str(t).strip()]
+    kata_data = dict(kata_data, topics=topics)
+
+    validation_errors = validate_kata_data(kata_data)
+    if validation_errors:
+        return None, None, validation_errors
+
+    content = kata_data['content']
+    values = (kata_data['title'], content, kata_data['difficulty'], kata_data['completion_time'],
+              " ".join(topics), render_kata_html(content), kata_html_hash(content))
+    return values, list(dict.fromkeys(topics)), []
+
+def import_katas(db, author_id, kata_items, result=None, progress=None, chunk_size=BULK_CHUNK_SIZE):
+    """Insert katas from an iterable chunk by chunk, committing each chunk.
+
+    Counts go into `result` ({'uploaded', 'failed', 'errors'}), which is
+    also returned and stays accurate if `kata_items` raises part way.
+    Invalid or failing rows are reported individually and never take the
+    rest of their chunk down with them; only the first MAX_REPORTED_ERRORS
+    messages are kept. `progress(result)` is called inside every chunk's
+    transaction, just before its commit, so whatever it writes commits with
+    the rows; result['processed'] counts the rows consumed up to that commit.
+    """
+    if result is None:
+        result = {'uploaded': 0, 'failed': 0, 'errors': []}
+    result.setdefault('processed', 0)
+    start_row = result['processed']
+    cursor = db.cursor()
+    topic_ids = {}
+
+    def report(row_number, title, message):
+        result['failed'] += 1
+        if len(result['errors']) < MAX_REPORTED_ERRORS:
+            result['errors'].append(f"Error for kata #{row_number} '{title}': {message}")
+
+    def insert_rows(rows):
+        kata_ids = []
+        for _, values, _, _ in rows:
+            cursor.execute("INSERT INTO katas (title, content, author_id, difficulty, completion_time, topics_text, html_content, html_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING id",
+                           (values[0], values[1], author_id) + values[2:])
+            kata_ids.append(cursor.fetchone()[0])
+        cursor.executemany("INSERT INTO kata_topics (kata_id, topic_id) VALUES (?, ?)",
+                           [(kata_id, topic_ids[name]) for kata_id, (_, _, topics, _) in zip(kata_ids, rows) for name in topics])
+        return kata_ids
+
+    def flush(rows, processed):
+        result['processed'] = processed
+        unique_rows = []
+        for row in rows:
+            duplicate = dedup.find_duplicate(cursor, row[3])
+            if duplicate:
+                report(row[0], row[1][0], f"Near-duplicate of existing kata #{duplicate[0]}.")
+            else:
+                unique_rows.append(row)
+        rows = unique_rows
+        if not rows:
+            if progress:
+                progress(result)
+                db.commit()
+            return
+        # Topics are committed up front so a rolled back chunk can't leave stale ids in the cache
+        resolve_topic_ids(cursor, [name for _, _, topics, _ in rows for name in topics], topic_ids)
+        db.commit()
+        # Opened explicitly: a SAVEPOINT outside a transaction would commit on RELEASE
+        cursor.execute("BEGIN IMMEDIATE")
+        inserted = []
         try:
-            kata_data_list.extend(json.loads(json_data_str))
-        except json.JSONDecodeError as e:
-            errors.append(f"Error parsing JSON data: {e}")
+            cursor.execute("SAVEPOINT bulk_chunk")
+            inserted = list(zip(insert_rows(rows), rows))
+            cursor.execute("RELEASE bulk_chunk")
+        except sqlite3.DatabaseError:
+            cursor.execute("ROLLBACK TO bulk_chunk")
+            cursor.execute("RELEASE bulk_chunk")
+            # Retry one by one to isolate the bad rows
+            for row in rows:
+                try:
+                    cursor.execute("SAVEPOINT bulk_row")
+                    inserted.extend(zip(insert_rows([row]), [row]))
+                    cursor.execute("RELEASE bulk_row")
+                except sqlite3.DatabaseError as e:
+                    cursor.execute("ROLLBACK TO bulk_row")
+                    cursor.execute("RELEASE bulk_row")
+                    report(row[0], row[1][0], e)
+        for kata_id, (_, _, _, sig) in inserted:
+            dedup.add_kata(cursor, kata_id, sig)
+        similar.add_katas(db, [kata_id for kata_id, _ in inserted])
+        result['uploaded'] += len(inserted)
+        if progress:
+            progress(result)
+        db.commit()
+        for kata_id, (_, values, topics, _) in inserted:
+            suggestions.add_kata(kata_id, values[0])
+            for topic_name in topics:
+                suggestions.add_topic(topic_name)
 
-    if json_file and json_file.filename != '':
+    chunk = []
+    pending = dedup.PendingBuckets()  # duplicates within the current chunk
+    row_number = start_row
+    try:
+        for row_number, kata_data in enumerate(kata_items, start=start_row + 1):
+            title = kata_data.get('title', 'N/A') if isinstance(kata_data, dict) else 'N/A'
+            try:
+                values, topics, validation_errors = prepare_bulk_kata(kata_data)
+            except Exception as e:
+                validation_errors = [f"Error processing kata: {e}"]
+            if validation_errors:
+                for error in validation_errors:
+                    report(row_number, title, error)
+                continue
+            sig = dedup.signature(values[0], values[1])
+            duplicate_row = pending.find(sig)
+            if duplicate_row is not None:
+                report(row_number, title, f"Near-duplicate of kata #{duplicate_row} in this upload.")
+                continue
+            pending.add(row_number, sig)
+            chunk.append((row_number, values, topics, sig))
+            if len(chunk) >= chunk_size:
+                rows, chunk = chunk, []
+                pending = dedup.PendingBuckets()
+                flush(rows, row_number)
+    except ValueError:
+        # Rows parsed before a syntax error in the stream are still imported
+        if chunk:
+            flush(chunk, row_number)
+        raise
+    flush(chunk, row_number)
+    return result
+
+def iter_job_katas(sources, result):
+    """Chain the katas of a job's spooled sources, recording parse errors instead of stopping."""
+    for source_name, path in sources:
+        with open(path, 'r', encoding='utf-8') as stream:
+            try:
+                yield from iter_json_array(stream)
+            except ValueError as e:
+                if len(result['errors']) < MAX_REPORTED_ERRORS:
+                    result['errors'].append(f"Error parsing {source_name}: {e}")
+
+def run_import_job(job_id):
+    """Process one queued import job; runs on the job executor, outside any request."""
+    db = connect()
+    try:
+        cursor = db.cursor()
+        cursor.execute("UPDATE import_jobs SET status = 'running', updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'queued'", (job_id,))
+        db.commit()
+        if cursor.rowcount == 0:
+            return  # Claimed by another worker
+        cursor.execute("SELECT * FROM import_jobs WHERE id = ?", (job_id,))
+        job = cursor.fetchone()
+        sources = json.loads(job['sources'])
+        result = {'uploaded': job['uploaded'], 'failed': job['failed'], 'errors': json.loads(job['errors']), 'processed': job['processed']}
+
+        def save_progress(result, status='running'):
+            # Not committed here: import_katas commits it with the chunk it describes
+            db.execute("UPDATE import_jobs SET status = ?, processed = ?, uploaded = ?, failed = ?, errors = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                       (status, result['processed'], result['uploaded'], result['failed'], json.dumps(result['errors']), job_id))
+
+        # A resumed job skips the rows it already committed
+        kata_items = itertools.islice(iter_job_katas(sources, result), result['processed'], None)
         try:
-            file_content = json_file.read().decode('utf-8')
-            kata_data_list.extend(json.loads(file_content))
-        except json.JSONDecodeError as e:
-            errors.append(f"Error parsing JSON file: {e}")
+            import_katas(db, job['user_id'], kata_items, result, progress=save_progress)
+            save_progress(result, status='done')
         except Exception as e:
-            errors.append(f"Error reading JSON file: {e}")
+            db.rollback()
+            # The counts in memory may include the chunk that was rolled back
+            cursor.execute("SELECT processed, uploaded, failed, errors FROM import_jobs WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            result = {'processed': row['processed'], 'uploaded': row['uploaded'], 'failed': row['failed'], 'errors': json.loads(row['errors'])}
+            result['errors'].append(f"Import stopped: {e}")
+            save_progress(result, status='failed')
+        db.commit()
+        # Done or failed, the job is never run again
+        for _, path in sources:
+            if os.path.exists(path):
+                os.remove(path)
+    finally:
+        db.close()
 
-    if not kata_data_list and not errors:
-        flash('No JSON data or file provided for bulk upload.', 'info')
-        return redirect(url_for('submit_kata'))
+_job_executor = None
+_job_executor_pid = None
+_job_executor_lock = threading.Lock()
+
+def get_job_executor():
+    """Start this process's job workers on first use, resuming any unfinished jobs."""
+    global _job_executor, _job_executor_pid
+    # Created lazily so a pre-forking server doesn't start threads in its master
+    if _job_executor is None or _job_executor_pid != os.getpid():
+        with _job_executor_lock:
+            if _job_executor is None or _job_executor_pid != os.getpid():
+                _job_executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix='import-job')
+                _job_executor_pid = os.getpid()
+                db = get_db()
+                # Jobs whose worker died mid-run stop heartbeating; put them back in the queue
+                db.execute("UPDATE import_jobs SET status = 'queued' WHERE status = 'running' AND updated_at < datetime('now', ?)",
+                           (f'-{STALE_JOB_MINUTES} minutes',))
+                db.commit()
+                for row in db.execute("SELECT id FROM import_jobs WHERE status = 'queued' ORDER BY id").fetchall():
+                    _job_executor.submit(run_import_job, row['id'])
+    return _job_executor
 
-    for kata_data in kata_data_list:
-        try:
-            # Adapt to the expected structure for validate_kata_data
-            topics_str = kata_data.get('topics', '')
-            kata_data['topics'] = [t.strip() for t in topics_str.split(',') if t.strip()]
+@app.before_request
+def resume_import_jobs():
+    if READ_ONLY:
+        return
+    if _job_executor is None or _job_executor_pid != os.getpid():
+        get_job_executor()
 
-            validation_errors = validate_kata_data(kata_data)
-            if validation_errors:
-                for error in validation_errors:
-                    errors.append(f"Error for kata '{kata_data.get('title', 'N/A')}': {error}")
-                continue
+@app.route('/bulk_upload_katas', methods=['POST'])
+@login_required(message='Please log in to bulk upload katas.')
+def bulk_upload_katas():
+    user = g.current_user
 
-            title = kata_data.get('title')
-            content = kata_data.get('content')
-            topics = kata_data.get('topics')
-            difficulty = kata_data.get('difficulty')
-            completion_time = kata_data.get('completion_time')
-            topics_text = " ".join(topics)
+    json_data_str = request.form.get('json_data')
+    json_file = request.files.get('json_file')
 
-            author_id = user['id']
+    if not json_data_str and not (json_file and json_file.filename != ''):
+        flash('No JSON data or file provided for bulk upload.', 'info')
+        return redirect(url_for('submit_kata'))
 
-            cursor.execute("INSERT INTO katas (title, content, author_id, difficulty, completion_time, topics_text) VALUES (?, ?, ?, ?, ?, ?)",
-                           (title, content, author_id, difficulty, completion_time, topics_text))
-            kata_id = cursor.lastrowid
-            
-            for topic_name in topics:
-                cursor.execute("INSERT OR IGNORE INTO topics (name) VALUES (?) ", (topic_name,))
-                cursor.execute("SELECT id FROM topics WHERE name = ?", (topic_name,))
-                topic_id = cursor.fetchone()[0]
-                cursor.execute("INSERT INTO kata_topics (kata_id, topic_id) VALUES (?, ?)", (kata_id, topic_id))
+    # Spool the uploads to disk; parsing and inserting happen on the job workers
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    sources = []
+    if json_data_str:
+        path = os.path.join(UPLOAD_DIR, f'{uuid.uuid4().hex}.json')
+        with open(path, 'w', encoding='utf-8') as spool:
+            spool.write(json_data_str)
+        sources.append(('JSON data', path))
+    if json_file and json_file.filename != '':
+        path = os.path.join(UPLOAD_DIR, f'{uuid.uuid4().hex}.json')
+        json_file.save(path)
+        sources.append(('JSON file', path))
 
-            uploaded_count += 1
-        except Exception as e:
-            errors.append(f"Error processing kata {kata_data.get('title', 'N/A')}: {e}")
-            db.rollback()
-            continue
-    
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("INSERT INTO import_jobs (user_id, sources) VALUES (?, ?)", (user['id'], json.dumps(sources)))
+    job_id = cursor.lastrowid
     db.commit()
+    get_job_executor().submit(run_import_job, job_id)
+
+    flash(f'Bulk upload queued as job #{job_id}.', 'success')
+    return redirect(url_for('job_status', job_id=job_id))
+
+def build_job_payload(job):
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'processed': job['processed'],
+        'uploaded': job['uploaded'],
+        'failed': job['failed'],
+        'errors': json.loads(job['errors']),
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at'],
+    }
 
-    if uploaded_count > 0:
-        flash(f'Successfully uploaded {uploaded_count} katas.', 'success')
-    if errors:
-        for error_msg in errors:
-            flash(error_msg, 'error')
+@app.route('/jobs/<int:job_id>')
+@login_required(response_type='json')
+def job_status(job_id):
+    user = g.current_user
 
-    return redirect(url_for('index'))
+    db = get_db()
+    cursor = db.cursor()
+    cursor.execute("SELECT * FROM import_jobs WHERE id = ? AND user_id = ?", (job_id, user['id']))
+    job = cursor.fetchone()
+    if not job:
+        return jsonify({'success': False, 'message': 'Job not found or unauthorized.'}), 404
+
+    job_payload = build_job_payload(job)
+    if request.headers.get('HX-Request'):
+        return render_template('partials/job_status.html', job=job_payload)
+    if request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html':
+        return render_template('job.html', job=job_payload, user=user)
+    return jsonify({'success': True, 'job': job_payload})
 
 @app.route('/prompts')
 @login_required(message='Please log in to manage your prompts.')
@@ -876,6 +1695,16 @@ def delete_prompt(prompt_id):
     else:
         return jsonify({'success': False, 'message': 'Prompt not found or unauthorized.'}), 404
 
+def resolve_recent_kata_placeholders(names, user_id):
+    """Expand "recent katas" placeholders to JSON with one id query and one batched kata fetch."""
+    cursor = get_db().cursor()
+    ids_by_action = recent_kata_ids(cursor, user_id, names)
+    all_ids = sorted({kata_id for ids in ids_by_action.values() for kata_id in ids})
+    cursor.execute("SELECT k.*, u.display_name as author_display_name FROM katas k JOIN users u ON k.author_id = u.id WHERE k.id IN (SELECT value FROM json_each(?))",
+                   (json.dumps(all_ids),))
+    katas_by_id = {kata['id']: kata for kata in hydrate_katas(cursor.fetchall(), user_id, include_notes=True)}
+    return recent_kata_values(names, ids_by_action, katas_by_id)
+
 @app.route('/compile_prompt', methods=['POST'])
 @login_required(response_type='json')
 def compile_prompt():
@@ -885,67 +1714,7 @@ def compile_prompt():
     if not prompt_content:
         return jsonify({'success': False, 'message': 'Prompt content is required.'}), 400
 
-    # Replace [[ allowed_difficulties ]]
-    compiled_content = prompt_content.replace('[[ allowed_difficulties ]]', ', '.join(ALLOWED_DIFFICULTIES))
-    
-    # Replace [[ allowed_times ]]
-    compiled_content = compiled_content.replace('[[ allowed_times ]]', ', '.join(ALLOWED_COMPLETION_TIMES))
-
-    compiled_content = compiled_content.replace('[[ schema_details ]]', SCHEMA_DETAILS_DESCRIPTION)
-
-    # Helper to fetch kata details for JSON output
-    def fetch_kata_details(kata_id):
-        kata_dict = get_kata_by_id(kata_id, user['id'])
-        if kata_dict:
-            return build_kata_export_payload(kata_dict, include_user_state=True)
-        return None
-
-    def build_kata_list_json(kata_ids):
-        exports = []
-        for kata_id in kata_ids:
-            details = fetch_kata_details(kata_id)
-            if details:
-                exports.append(details)
-        return json.dumps(exports, indent=2)
-
-    # Replace [[ your_10_last_upvoted ]]
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute("""
-        SELECT k.id FROM katas k
-        JOIN user_kata_actions uka ON k.id = uka.kata_id
-        WHERE uka.user_id = ? AND uka.action_type = 'upvote'
-        ORDER BY uka.timestamp DESC
-        LIMIT 10
-    """, (user['id'],))
-    upvoted_kata_ids = [row['id'] for row in cursor.fetchall()]
-    upvoted_katas_json = build_kata_list_json(upvoted_kata_ids)
-    compiled_content = compiled_content.replace('[[ your_10_last_upvoted ]]', upvoted_katas_json)
-
-    # Replace [[ your_10_last_saved ]]
-    cursor.execute("""
-        SELECT k.id FROM katas k
-        JOIN user_kata_actions uka ON k.id = uka.kata_id
-        WHERE uka.user_id = ? AND uka.action_type = 'save'
-        ORDER BY uka.timestamp DESC
-        LIMIT 10
-    """, (user['id'],))
-    saved_kata_ids = [row['id'] for row in cursor.fetchall()]
-    saved_katas_json = build_kata_list_json(saved_kata_ids)
-    compiled_content = compiled_content.replace('[[ your_10_last_saved ]]', saved_katas_json)
-
-    # Replace [[ your_last_completed ]]
-    cursor.execute("""
-        SELECT k.id FROM katas k
-        JOIN user_kata_actions uka ON k.id = uka.kata_id
-        WHERE uka.user_id = ? AND uka.action_type = 'complete'
-        ORDER BY uka.timestamp DESC
-        LIMIT 10
-    """, (user['id'],))
-    completed_kata_ids = [row['id'] for row in cursor.fetchall()]
-    completed_katas_json = build_kata_list_json(completed_kata_ids)
-    compiled_content = compiled_content.replace('[[ your_last_completed ]]', completed_katas_json)
-
+    compiled_content = compile_prompt_text(prompt_content, user['id'], resolve_recent_kata_placeholders)
     return jsonify({'success': True, 'compiled_content': compiled_content})
 
 @app.route('/delete_account', methods=['GET'])
@@ -966,6 +1735,9 @@ def delete_account():
             placeholders = ', '.join('?' for _ in kata_ids)
             cursor.execute(f"DELETE FROM user_kata_actions WHERE kata_id IN ({placeholders})", kata_ids)
             cursor.execute(f"DELETE FROM kata_topics WHERE kata_id IN ({placeholders})", kata_ids)
+            for kata_id in kata_ids:
+                similar.remove_kata(db, kata_id)
+                dedup.remove_kata(cursor, kata_id)
             # Delete the katas
             cursor.execute(f"DELETE FROM katas WHERE id IN ({placeholders})", kata_ids)
 
@@ -982,10 +1754,143 @@ def delete_account():
         flash(f'An error occurred while deleting your account: {e}', 'error')
         return redirect(url_for('index'))
 
+    for kata_id in kata_ids:
+        suggestions.remove_kata(kata_id)
+
     session.pop('username', None)
+    session.pop('user', None)
     flash('Your account has been successfully deleted.', 'success')
     return redirect(url_for('index'))
 
+@app.cli.command('backfill-html')
+def backfill_html():
+    """Render and store HTML for katas whose stored copy is missing or stale."""
+    db = get_db()
+    read_cursor = db.cursor()
+    read_cursor.execute("SELECT id, content, html_hash FROM katas")
+    updated = 0
+    while True:
+        rows = read_cursor.fetchmany(500)
+        if not rows:
+            break
+        stale = [row for row in rows if row['html_hash'] != kata_html_hash(row['content'])]
+        db.executemany("UPDATE katas SET html_content = ?, html_hash = ? WHERE id = ?",
+                       [(render_kata_html(row['content']), kata_html_hash(row['content']), row['id']) for row in stale])
+        updated += len(stale)
+    db.commit()
+    print(f"Rendered HTML for {updated} katas.")
+
+@app.cli.command('find-duplicates')
+def find_duplicates():
+    """Print clusters of near-duplicate katas across the whole corpus."""
+    db = get_db()
+    indexed = dedup.index_missing(db)
+    if indexed:
+        print(f"Computed signatures for {indexed} katas.")
+    clusters = dedup.find_clusters(db)
+    for kata_ids in clusters:
+        rows = db.execute("SELECT id, title FROM katas WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id", (json.dumps(kata_ids),)).fetchall()
+        print(f"{len(kata_ids)} near-duplicates: " + "; ".join(f"#{row['id']} {row['title']}" for row in rows))
+    print(f"Found {len(clusters)} clusters.")
+
+@app.cli.command('rebuild-search')
+def rebuild_search():
+    """Reindex every kata for full-text search."""
+    db = get_db()
+    rebuild_search_index(db.cursor())
+    db.commit()
+    print("Search index rebuilt.")
+
+@app.cli.command('rebuild-similar')
+def rebuild_similar():
+    """Recompute the similar-katas index for the whole corpus."""
+    similar.rebuild(get_db())
+
+# EXPLAIN QUERY PLAN details that don't mean a table is read in full
+INDEXED_PLAN_MARKERS = ('USING INDEX', 'USING COVERING INDEX', 'USING INTEGER PRIMARY KEY', 'USING PRIMARY KEY',
+                        'VIRTUAL TABLE', 'CONSTANT ROW', '(subquery-')
+
+@app.cli.command('check-query-plans', with_appcontext=False)
+def check_query_plans():
+    """Request the read routes and fail if any query they run scans a whole table."""
+    # No app context here: each test request gets its own, and with it a pooled connection
+    db = connect()
+    kata = db.execute("SELECT id, created_at FROM katas ORDER BY id LIMIT 1").fetchone()
+    topic = db.execute("SELECT name FROM topics ORDER BY id LIMIT 1").fetchone()
+    user = db.execute("SELECT secret_username FROM users ORDER BY id LIMIT 1").fetchone()
+    kata_id = kata['id'] if kata else 1
+    after = encode_cursor('created_at', [kata['created_at'], kata['id']]) if kata else ''
+    anonymous_paths = ['/', '/?sort_by=upvotes', '/?sort_by=saves', '/?difficulty=easy', '/?completion_time=<10 mins',
+                       '/?difficulty=easy&sort_by=upvotes', f"/?topic={topic['name'] if topic else 'numpy'}",
+                       '/?created_at=this_week', '/?search=model', '/?search=model&sort_by=created_at', '/?search=q-learning&difficulty=easy',
+                       f'/?after={after}', f'/kata/{kata_id}', '/autocomplete?query=a', '/topics',
+                       '/api/v1/katas', '/api/v1/katas?fields=id,title&sort_by=upvotes', f'/api/v1/katas?after={after}&format=ndjson',
+                       f'/api/v1/katas?ids={kata_id}&fields=id,content']
+    user_paths = ['/', '/?sort_by=upvotes', '/?search=model', f'/kata/{kata_id}', '/saved', '/completed', '/my_katas', '/prompts']
+
+    statements = []
+    pool = get_pool()
+    connections = [pool.acquire() for _ in range(pool.size)]
+    for conn in connections:
+        conn.set_trace_callback(statements.append)
+        pool.release(conn)
+
+    client = app.test_client()
+    requests_to_check = [(path, None) for path in anonymous_paths]
+    if user:
+        requests_to_check += [(path, user['secret_username']) for path in user_paths]
+    failures = 0
+    for path, username in requests_to_check:
+        with client.session_transaction() as sess:
+            sess.clear()
+            if username:
+                sess['username'] = username
+        statements.clear()
+        response = client.get(path)
+        for sql in list(statements):
+            # Skip writes and FTS5's own reads of its shadow tables
+            if not sql.lstrip().upper().startswith(('SELECT', 'WITH')) or "_fts_" in sql:
+                continue
+            plan = [row['detail'] for row in db.execute("EXPLAIN QUERY PLAN " + sql).fetchall()]
+            scans = [detail for detail in plan if detail.startswith('SCAN ') and not any(marker in detail for marker in INDEXED_PLAN_MARKERS)]
+            if 'USE TEMP B-TREE FOR ORDER BY' in plan:
+                # Walking an index doesn't help if every row is then read to be sorted
+                scans += [detail for detail in plan if detail.startswith('SCAN ') and '(subquery-' not in detail and 'VIRTUAL TABLE' not in detail and detail not in scans]
+            if scans:
+                failures += 1
+                print(f"{path} ({'user' if username else 'anonymous'}, HTTP {response.status_code}) full scan: {'; '.join(scans)}")
+                print(f"    {' '.join(sql.split())[:300]}")
+    for conn in connections:
+        conn.set_trace_callback(None)
+    db.close()
+
+    if failures:
+        print(f"{failures} queries scan a whole table.")
+        raise SystemExit(1)
+    print(f"All queries for {len(requests_to_check)} requests use an index.")
+
+@app.cli.command('export-katas')
+@click.option('--user', 'secret_username', help="Secret username whose katas to export (not needed for --source filter).")
+@click.option('--source', type=click.Choice(EXPORT_SOURCES), default='saved')
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='anki')
+@click.option('--filter', 'filters', multiple=True, help="Listing filter as key=value, e.g. difficulty=easy (repeatable).")
+@click.option('--gzip', 'compress', is_flag=True, help="Gzip the output.")
+@click.option('--output', type=click.File('wb'), default='-', help="File to write (default: stdout).")
+def export_katas_command(secret_username, source, fmt, filters, compress, output):
+    """Export katas as Anki TSV, CSV or JSONL study cards."""
+    user_id = None
+    if secret_username:
+        try:
+            user_id = load_user(secret_username, get_cache_state_row()['accounts_generation'])['id']
+        except LookupError:
+            raise click.ClickException(f"No user {secret_username!r}.")
+    elif source != 'filter':
+        raise click.ClickException("--user is required for this source.")
+    args = dict(item.split('=', 1) for item in filters)
+    chunks = iter_export(source, fmt, user_id, args)
+    for chunk in (gzip_chunks(chunks) if compress else (chunk.encode('utf-8') for chunk in chunks)):
+        output.write(chunk)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     print(port)
@@ -0,0 +1,438 @@
+# /// script
+# requires-python = ">=3.9"
+# dependencies = [
+#     "blinker",
+#     "click",
+#     "flask",
+#     "latex2mathml",
+#     "markdown2",
+# ]
+# ///
+"""Synthetic corpus generator and load driver.
+
+    python bench.py generate --db bench.db --users 10000 --katas 200000
+    python bench.py run --db bench.db --concurrency 8 --duration 30 > before.json
+    python bench.py run --url http://127.0.0.1:8000 --db bench.db --concurrency 32 --duration 30
+    python bench.py startup --db bench.db --worker-budget-ms 50
+
+`run` drives the app in-process through the Flask test client, or a live
+server with --url (start it with SERVER_TIMING=1 to get queries per
+request). It prints p50/p95/p99 latency, throughput and queries per request
+for each route as JSON, so runs can be diffed between commits.
+
+`startup` times what a pre-forking deploy pays: importing wsgi.py in the
+master, and a forked worker's first response. It exits non-zero when
+either median is over its budget, so it can gate a deploy or CI job.
+"""
+import argparse
+import bisect
+import json
+import math
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+from http.cookiejar import CookieJar
+
+BENCH_USER_PREFIX = 'bench-user-'
+
+FRAMEWORKS = ['numpy', 'pytorch', 'jax', 'tensorflow', 'scikit-learn', 'pandas']
+CONCEPTS = [
+    'attention', 'convolution', 'batch norm', 'layer norm', 'dropout', 'softmax', 'cross entropy', 'adam',
+    'sgd momentum', 'backpropagation', 'gradient clipping', 'k-means', 'pca', 'svd', 'logistic regression',
+    'linear regression', 'decision tree', 'random forest', 'gradient boosting', 'naive bayes', 'knn', 'lstm',
+    'gru', 'transformer block', 'positional encoding', 'beam search', 'tokenizer', 'word2vec', 'vae', 'gan',
+    'diffusion step', 'ppo', 'q-learning', 'policy gradient', 'kl divergence', 'em algorithm', 'gmm', 'hmm',
+    'kalman filter', 'bayesian optimization', 'gaussian process', 'contrastive loss', 'triplet loss', 'lora',
+    'quantization', 'pruning', 'distillation', 'mixture of experts', 'rope', 'flash attention', 'kv cache',
+]
+VERBS = ['Implement', 'Derive', 'Vectorize', 'Debug', 'Visualize', 'Benchmark', 'Explain', 'Re-implement']
+DIFFICULTIES = ['easy', 'medium', 'hard']
+COMPLETION_TIMES = ['<10 mins', '<30 mins', '<1 hr', '>1 hr']
+FORMULAS = [r'\sigma(x) = \frac{1}{1 + e^{-x}}', r'\mathrm{softmax}(z)_i = \frac{e^{z_i}}{\sum_j e^{z_j}}',
+            r'\nabla_\theta J(\theta) = \mathbb{E}[\nabla_\theta \log \pi_\theta(a|s) R]',
+            r'\mathrm{Attention}(Q, K, V) = \mathrm{softmax}(QK^T / \sqrt{d_k}) V']
+
+
+def zipf_weights(n, s=1.1):
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def topic_names():
+    names = [concept.replace(' ', '-') for concept in CONCEPTS] + FRAMEWORKS
+    names += [f'{a.split()[0]}-{b}' for a in CONCEPTS for b in FRAMEWORKS][:240]
+    return list(dict.fromkeys(name[:20] for name in names))
+
+
+def kata_body(rng, concept, framework):
+    formula = rng.choice(FORMULAS)
+    steps = '\n'.join(f'{i}. {rng.choice(VERBS)} the {rng.choice(CONCEPTS)} part.' for i in range(1, rng.randint(3, 7)))
+    return (f"## Goal\n\nWrite {concept} from scratch in {framework}.\n\n$$ {formula} $$\n\n"
+            f"### Steps\n\n{steps}\n\n```python\nimport {framework.replace('-', '_')}\n\ndef {concept.replace(' ', '_').replace('-', '_')}(x):\n"
+            f"    raise NotImplementedError\n```\n\nCompare against the reference implementation on random inputs.")
+
+
+def generate(args):
+    os.environ['DATABASE_PATH'] = args.db
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+    import database
+    database.init_db()
+
+    rng = random.Random(args.seed)
+    conn = sqlite3.connect(args.db)
+    started = time.perf_counter()
+
+    conn.executemany("INSERT INTO users (id, secret_username, display_name) VALUES (?, ?, ?)",
+                     [(i, f'{BENCH_USER_PREFIX}{i}', f'User {i}') for i in range(1, args.users + 1)])
+
+    names = topic_names()
+    conn.executemany("INSERT INTO topics (id, name) VALUES (?, ?)", list(enumerate(names, start=1)))
+    topic_weights = zipf_weights(len(names))
+    # A few prolific authors write most katas
+    author_weights = zipf_weights(args.users, 1.0)
+    now = datetime.now()
+
+    batch, kata_topics = [], []
+    for kata_id in range(1, args.katas + 1):
+        concept, framework = rng.choice(CONCEPTS), rng.choice(FRAMEWORKS)
+        topic_ids = sorted(set(rng.choices(range(1, len(names) + 1), weights=topic_weights, k=rng.randint(1, 4))))
+        created_at = now - timedelta(seconds=rng.randint(0, 2 * 365 * 86400))
+        batch.append((kata_id, f'{rng.choice(VERBS)} {concept} in {framework} #{kata_id}', kata_body(rng, concept, framework),
+                      rng.choices(range(1, args.users + 1), weights=author_weights)[0], rng.choice(DIFFICULTIES),
+                      rng.choice(COMPLETION_TIMES), ', '.join(names[t - 1] for t in topic_ids),
+                      created_at.strftime('%Y-%m-%d %H:%M:%S')))
+        kata_topics.extend((kata_id, topic_id) for topic_id in topic_ids)
+        if len(batch) >= 5000 or kata_id == args.katas:
+            conn.executemany("INSERT INTO katas (id, title, content, author_id, difficulty, completion_time, topics_text, created_at) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            conn.executemany("INSERT INTO kata_topics (kata_id, topic_id) VALUES (?, ?)", kata_topics)
+            conn.commit()
+            batch, kata_topics = [], []
+            print(f"katas: {kata_id}/{args.katas}", file=sys.stderr)
+
+    # Heavy-tailed activity: a Pareto number of actions per user over Zipf-popular katas
+    kata_weights = zipf_weights(args.katas, 0.9)
+    cumulative = list(_cumulative(kata_weights))
+    actions = []
+    for user_id in range(1, args.users + 1):
+        count = min(args.katas, int(rng.paretovariate(1.2) * args.actions_scale))
+        for kata_id in set(_sample(rng, cumulative, count)):
+            for action, probability in (('upvote', 0.6), ('save', 0.3), ('complete', 0.25)):
+                if rng.random() < probability:
+                    actions.append((user_id, kata_id, action))
+        if len(actions) >= 50000 or user_id == args.users:
+            conn.executemany("INSERT OR IGNORE INTO user_kata_actions (user_id, kata_id, action_type) VALUES (?, ?, ?)", actions)
+            conn.commit()
+            actions = []
+    conn.execute("""
+        UPDATE katas SET
+            upvotes = (SELECT COUNT(*) FROM user_kata_actions WHERE kata_id = katas.id AND action_type = 'upvote'),
+            saves = (SELECT COUNT(*) FROM user_kata_actions WHERE kata_id = katas.id AND action_type = 'save'),
+            completions = (SELECT COUNT(*) FROM user_kata_actions WHERE kata_id = katas.id AND action_type = 'complete')
+    """)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+    if args.index:
+        # Rendered HTML, similar katas and dedup signatures, as the CLI commands would build them
+        import app as app_module
+        runner = app_module.app.test_cli_runner()
+        for command in ('backfill-html', 'rebuild-similar', 'find-duplicates'):
+            print(runner.invoke(args=[command]).output, file=sys.stderr)
+
+    stats = {'db': args.db, 'users': args.users, 'katas': args.katas, 'seconds': round(time.perf_counter() - started, 1)}
+    with sqlite3.connect(args.db) as conn:
+        stats['actions'] = conn.execute("SELECT COUNT(*) FROM user_kata_actions").fetchone()[0]
+    print(json.dumps(stats, indent=2))
+
+
+def _cumulative(weights):
+    total = 0.0
+    for weight in weights:
+        total += weight
+        yield total
+
+
+def _sample(rng, cumulative, count):
+    total = cumulative[-1]
+    return [bisect.bisect_left(cumulative, rng.random() * total) + 1 for _ in range(count)]
+
+
+class Workload:
+    """Picks the next request for a virtual user; ids and topics follow the corpus' skew."""
+
+    def __init__(self, db_path, seed):
+        conn = sqlite3.connect(db_path)
+        self.max_kata_id = conn.execute("SELECT MAX(id) FROM katas").fetchone()[0] or 1
+        self.max_user_id = conn.execute("SELECT MAX(id) FROM users").fetchone()[0] or 1
+        self.topics = [row[0] for row in conn.execute("SELECT name FROM topics ORDER BY id LIMIT 100")]
+        conn.close()
+        self.kata_cumulative = list(_cumulative(zipf_weights(min(self.max_kata_id, 100000), 0.9)))
+        self.seed = seed
+        self.routes = {
+            'index': (20, False, lambda rng: ('GET', '/', None)),
+            'index_sorted': (5, False, lambda rng: ('GET', f"/?sort_by={rng.choice(['upvotes', 'saves'])}", None)),
+            'filter': (10, False, lambda rng: ('GET', '/?' + urllib.parse.urlencode(
+                {'difficulty': rng.choice(DIFFICULTIES), 'topic': rng.choice(self.topics)}), None)),
+            'search': (8, False, lambda rng: ('GET', '/?' + urllib.parse.urlencode({'search': rng.choice(CONCEPTS).split()[0]}), None)),
+            'autocomplete': (15, False, lambda rng: ('GET', '/autocomplete?' + urllib.parse.urlencode(
+                {'query': rng.choice(CONCEPTS)[:rng.randint(1, 5)]}), None)),
+            'kata': (25, False, lambda rng: ('GET', f'/kata/{self.kata_id(rng)}', None)),
+            'saved': (3, True, lambda rng: ('GET', '/saved', None)),
+            'toggle': (10, True, lambda rng: ('POST', f"/kata/{self.kata_id(rng)}/{rng.choice(['upvote', 'save', 'complete'])}", {})),
+            'compile_prompt': (2, True, lambda rng: ('POST', '/compile_prompt', {
+                'prompt_content': 'Difficulties: [[ allowed_difficulties ]]\n[[ your_10_last_upvoted ]]\n[[ your_last_completed ]]'})),
+            'bulk_upload': (0.2, True, lambda rng: ('POST', '/bulk_upload_katas', {'json_data': json.dumps([
+                {'title': f'Bench upload {rng.random()}', 'content': kata_body(rng, rng.choice(CONCEPTS), rng.choice(FRAMEWORKS)),
+                 'topics': rng.choice(self.topics), 'difficulty': rng.choice(DIFFICULTIES),
+                 'completion_time': rng.choice(COMPLETION_TIMES)} for _ in range(20)])})),
+        }
+
+    def kata_id(self, rng):
+        return min(self.max_kata_id, _sample(rng, self.kata_cumulative, 1)[0])
+
+    def pick(self, rng, names, logged_in):
+        names = [name for name in names if logged_in or not self.routes[name][1]]
+        name = rng.choices(names, weights=[self.routes[name][0] for name in names])[0]
+        return name, self.routes[name][2](rng)
+
+
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def login(self, username):
+        self.client.post('/login', data={'secret_username': username, 'display_name': username})
+
+    def request(self, method, path, data):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.headers.get('Server-Timing')
+
+
+class HttpTransport:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+
+    def login(self, username):
+        self.request('POST', '/login', {'secret_username': username, 'display_name': username})
+
+    def request(self, method, path, data):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status, response.headers.get('Server-Timing')
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers.get('Server-Timing')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def queries_from_header(header):
+    # Server-Timing: sql;dur=1.23;desc="4 queries", total;dur=5.6
+    if not header or 'desc="' not in header:
+        return None
+    return int(header.split('desc="', 1)[1].split(' ', 1)[0])
+
+
+def run(args):
+    os.environ['DATABASE_PATH'] = args.db
+    workload = Workload(args.db, args.seed)
+    names = args.routes.split(',') if args.routes else list(workload.routes)
+    unknown = set(names) - set(workload.routes)
+    if unknown:
+        raise SystemExit(f"Unknown routes: {', '.join(sorted(unknown))}")
+
+    if args.url:
+        make_transport = lambda: HttpTransport(args.url)
+    else:
+        os.environ.setdefault('SERVER_TIMING', '1')
+        import app as app_module
+        app_module.SERVER_TIMING = True
+        if args.no_page_cache:
+            app_module.page_cache.max_entries = 0
+        make_transport = lambda: TestClientTransport(app_module.app)
+
+    samples = {name: [] for name in names}  # name -> [(seconds, status, queries)]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+    remaining = [args.requests]
+
+    def worker(index):
+        rng = random.Random(args.seed * 1000 + index)
+        transport = make_transport()
+        logged_in = rng.random() < args.logged_in
+        if logged_in:
+            transport.login(f'{BENCH_USER_PREFIX}{rng.randint(1, workload.max_user_id)}')
+        local = []
+        while time.perf_counter() < deadline:
+            if args.requests:
+                with lock:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+            name, (method, path, data) = workload.pick(rng, names, logged_in)
+            started = time.perf_counter()
+            status, timing = transport.request(method, path, data)
+            local.append((name, time.perf_counter() - started, status, queries_from_header(timing)))
+        with lock:
+            for name, seconds, status, queries in local:
+                samples[name].append((seconds, status, queries))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    report = {'meta': run_metadata(args, elapsed), 'routes': {}}
+    everything = []
+    for name, route_samples in samples.items():
+        if not route_samples:
+            continue
+        report['routes'][name] = summarize(route_samples, elapsed)
+        everything.extend(route_samples)
+    report['overall'] = summarize(everything, elapsed) if everything else None
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+def summarize(route_samples, elapsed):
+    latencies = sorted(seconds for seconds, _, _ in route_samples)
+    queries = [count for _, _, count in route_samples if count is not None]
+    errors = sum(1 for _, status, _ in route_samples if status >= 500)
+    return {
+        'requests': len(route_samples),
+        'errors': errors,
+        'throughput_rps': round(len(route_samples) / elapsed, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99': round(percentile(latencies, 0.99) * 1000, 2),
+            'mean': round(sum(latencies) / len(latencies) * 1000, 2),
+        },
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+def run_metadata(args, elapsed):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    with sqlite3.connect(args.db) as conn:
+        katas = conn.execute("SELECT COUNT(*) FROM katas").fetchone()[0]
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    return {'commit': commit, 'started_at': datetime.now().isoformat(timespec='seconds'), 'target': args.url or 'test-client',
+            'concurrency': args.concurrency, 'seconds': round(elapsed, 2), 'katas': katas, 'users': users,
+            'logged_in_share': args.logged_in, 'seed': args.seed}
+
+
+# Run in a fresh interpreter: import the app like the gunicorn master, then
+# fork like a worker and time its first request
+STARTUP_PROBE = r'''
+import json, os, time
+started = time.perf_counter()
+import wsgi
+loaded = time.perf_counter() - started
+reader, writer = os.pipe()
+forked = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    status = wsgi.app.test_client().get('/').status_code
+    os.write(writer, json.dumps([time.perf_counter() - forked, status]).encode())
+    os._exit(0)
+os.close(writer)
+first_request, status = json.loads(os.read(reader, 4096))
+os.waitpid(pid, 0)
+print(json.dumps({'import_ms': loaded * 1000, 'worker_first_request_ms': first_request * 1000, 'status': status}))
+'''
+
+
+def startup(args):
+    env = dict(os.environ, DATABASE_PATH=os.path.abspath(args.db))
+    samples = []
+    for _ in range(args.runs):
+        probe = subprocess.run([sys.executable, '-c', STARTUP_PROBE], capture_output=True, text=True, env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        if probe.returncode != 0:
+            sys.exit(f"Startup probe failed:\n{probe.stderr}")
+        samples.append(json.loads(probe.stdout.strip().splitlines()[-1]))
+    if any(sample['status'] != 200 for sample in samples):
+        sys.exit(f"Worker's first request failed: {samples}")
+
+    report = {'runs': args.runs}
+    over_budget = []
+    for key, budget in (('import_ms', args.import_budget_ms), ('worker_first_request_ms', args.worker_budget_ms)):
+        values = sorted(sample[key] for sample in samples)
+        median = values[len(values) // 2]
+        report[key] = {'median': round(median, 1), 'max': round(values[-1], 1), 'budget': budget}
+        if median > budget:
+            over_budget.append(key)
+    report['ok'] = not over_budget
+    print(json.dumps(report, indent=2))
+    if over_budget:
+        sys.exit(f"Over the startup budget: {', '.join(over_budget)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='Build a synthetic corpus (replaces the file).')
+    gen.add_argument('--db', default='bench.db')
+    gen.add_argument('--users', type=int, default=10000)
+    gen.add_argument('--katas', type=int, default=200000)
+    gen.add_argument('--actions-scale', type=float, default=5, help='Typical actions per user; the tail is Pareto.')
+    gen.add_argument('--index', action='store_true', help='Also render HTML and build the similar/dedup indexes (slow).')
+    gen.add_argument('--seed', type=int, default=1)
+
+    load = commands.add_parser('run', help='Drive the routes and print a JSON report.')
+    load.add_argument('--db', default='bench.db')
+    load.add_argument('--url', help='Benchmark a running server instead of the in-process test client.')
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--duration', type=float, default=30, help='Seconds to run.')
+    load.add_argument('--requests', type=int, default=0, help='Stop after this many requests instead.')
+    load.add_argument('--routes', help='Comma-separated subset of routes (default: all).')
+    load.add_argument('--logged-in', type=float, default=0.3, help='Share of virtual users that log in.')
+    load.add_argument('--no-page-cache', action='store_true', help='Disable the anonymous page cache (in-process only).')
+    load.add_argument('--seed', type=int, default=1)
+
+    boot = commands.add_parser('startup', help='Time app import and a forked worker\'s first request against budgets.')
+    boot.add_argument('--db', default='bench.db')
+    boot.add_argument('--runs', type=int, default=5)
+    boot.add_argument('--import-budget-ms', type=float, default=1000, help='Budget for importing wsgi.py in the master.')
+    boot.add_argument('--worker-budget-ms', type=float, default=50, help='Budget from fork to a worker\'s first response.')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args)
+    elif args.command == 'startup':
+        startup(args)
+    else:
+        if args.requests:
+            args.duration = float('inf')
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,202 @@
+import os
+import queue
 import sqlite3
+import threading
 
-DATABASE = 'database.db'
+from flask import g, has_app_context
+
+from metrics import InstrumentedConnection
+
+DATABASE = os.environ.get('DATABASE_PATH', 'database.db')
+# Read-only workers (e.g. serving from a replica) never write, not even the schema
+READ_ONLY = os.environ.get('READ_ONLY', '') not in ('', '0')
+
+# Connection pool / per-connection tuning
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+POOL_TIMEOUT = 10  # seconds to wait for a free pooled connection
+BUSY_TIMEOUT_MS = 5000
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 64 * 1024
+
+KATAS_FTS_SCHEMA = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS katas_fts USING fts5(
+        title, content, topics_text,
+        content='katas', content_rowid='id',
+        tokenize='porter unicode61 remove_diacritics 2'
+    )
+"""
+# An external-content index must be told the old text to remove it
+KATAS_FTS_TRIGGERS = [
+    """
+    CREATE TRIGGER katas_after_insert AFTER INSERT ON katas
+    BEGIN
+        INSERT INTO katas_fts (rowid, title, content, topics_text) VALUES (new.id, new.title, new.content, new.topics_text);
+    END
+    """,
+    """
+    CREATE TRIGGER katas_after_delete AFTER DELETE ON katas
+    BEGIN
+        INSERT INTO katas_fts (katas_fts, rowid, title, content, topics_text) VALUES ('delete', old.id, old.title, old.content, old.topics_text);
+    END
+    """,
+    """
+    CREATE TRIGGER katas_after_update AFTER UPDATE OF title, content, topics_text ON katas
+    BEGIN
+        INSERT INTO katas_fts (katas_fts, rowid, title, content, topics_text) VALUES ('delete', old.id, old.title, old.content, old.topics_text);
+        INSERT INTO katas_fts (rowid, title, content, topics_text) VALUES (new.id, new.title, new.content, new.topics_text);
+    END
+    """,
+]
+
+def rebuild_search_index(cursor):
+    """Reindex every kata from the katas table and merge the index into as few b-trees as possible."""
+    cursor.execute("INSERT INTO katas_fts (katas_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO katas_fts (katas_fts) VALUES ('optimize')")
+
+def migrate_katas_fts(cursor):
+    # Replace the contentful table (a second copy of all kata text) with the
+    # external-content one and reindex with the porter tokenizer
+    for name in ('katas_after_insert', 'katas_after_delete', 'katas_after_update'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+    cursor.execute("DROP TABLE IF EXISTS katas_fts")
+    cursor.execute(KATAS_FTS_SCHEMA)
+    for trigger in KATAS_FTS_TRIGGERS:
+        cursor.execute(trigger)
+    rebuild_search_index(cursor)
+
+def add_column_if_missing(cursor, table, column, definition):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+# Ordered schema changes applied on top of the tables created in init_db().
+# PRAGMA user_version records how many have run, so only ever append here.
+# A step is a list of SQL statements or a function taking a cursor.
+MIGRATIONS = [
+    [  # 1: indexes for the listing filters and sorts and the per-user pages
+        "CREATE INDEX IF NOT EXISTS idx_katas_created_at ON katas (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_katas_upvotes ON katas (upvotes)",
+        "CREATE INDEX IF NOT EXISTS idx_katas_saves ON katas (saves)",
+        "CREATE INDEX IF NOT EXISTS idx_katas_difficulty ON katas (difficulty, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_katas_completion_time ON katas (completion_time, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_katas_author ON katas (author_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_user_kata_actions_user_action ON user_kata_actions (user_id, action_type, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_user_kata_actions_kata ON user_kata_actions (kata_id)",
+        "CREATE INDEX IF NOT EXISTS idx_user_kata_notes_kata ON user_kata_notes (kata_id)",
+        "CREATE INDEX IF NOT EXISTS idx_kata_topics_topic ON kata_topics (topic_id, kata_id)",
+        "CREATE INDEX IF NOT EXISTS idx_prompts_user ON prompts (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_import_jobs_status ON import_jobs (status)",
+        "ANALYZE",
+    ],
+    [  # 2: only reindex FTS when indexed text changes, not on every counter bump
+        "DROP TRIGGER IF EXISTS katas_after_update",
+        """
+        CREATE TRIGGER katas_after_update AFTER UPDATE OF title, content, topics_text ON katas
+        BEGIN
+            UPDATE katas_fts SET title = new.title, content = new.content, topics_text = new.topics_text WHERE rowid = new.id;
+        END
+        """,
+    ],
+    [  # 3: a counter bumped when accounts are deleted or renamed, which invalidates user identities cached in sessions
+        "ALTER TABLE cache_state ADD COLUMN accounts_generation INTEGER NOT NULL DEFAULT 0",
+        """
+        CREATE TRIGGER users_bump_accounts_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE cache_state SET accounts_generation = accounts_generation + 1 WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER users_bump_accounts_update AFTER UPDATE OF secret_username, display_name ON users
+        BEGIN
+            UPDATE cache_state SET accounts_generation = accounts_generation + 1 WHERE id = 1;
+        END
+        """,
+    ],
+    migrate_katas_fts,  # 4: external-content FTS with the porter tokenizer
+    [  # 5: kata counts per topic ('' difficulty) and per topic and difficulty, kept current by triggers
+        """
+        CREATE TABLE topic_stats (
+            topic_id INTEGER NOT NULL,
+            difficulty TEXT NOT NULL,
+            katas INTEGER NOT NULL,
+            PRIMARY KEY (topic_id, difficulty)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX idx_topic_stats_difficulty ON topic_stats (difficulty, katas)",
+        "INSERT INTO topic_stats (topic_id, difficulty, katas) SELECT topic_id, '', COUNT(*) FROM kata_topics GROUP BY topic_id",
+        """
+        INSERT INTO topic_stats (topic_id, difficulty, katas)
+        SELECT kt.topic_id, k.difficulty, COUNT(*) FROM kata_topics kt JOIN katas k ON k.id = kt.kata_id
+        WHERE k.difficulty != '' GROUP BY kt.topic_id, k.difficulty
+        """,
+        # Katas are always linked to topics after they are inserted and unlinked before they are deleted
+        """
+        CREATE TRIGGER kata_topics_stats_insert AFTER INSERT ON kata_topics
+        BEGIN
+            INSERT INTO topic_stats (topic_id, difficulty, katas) VALUES (new.topic_id, '', 1)
+                ON CONFLICT (topic_id, difficulty) DO UPDATE SET katas = katas + 1;
+            INSERT INTO topic_stats (topic_id, difficulty, katas)
+                SELECT new.topic_id, difficulty, 1 FROM katas WHERE id = new.kata_id AND difficulty != ''
+                ON CONFLICT (topic_id, difficulty) DO UPDATE SET katas = katas + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER kata_topics_stats_delete AFTER DELETE ON kata_topics
+        BEGIN
+            UPDATE topic_stats SET katas = katas - 1
+                WHERE topic_id = old.topic_id AND (difficulty = '' OR difficulty = (SELECT difficulty FROM katas WHERE id = old.kata_id));
+            DELETE FROM topic_stats WHERE topic_id = old.topic_id AND katas <= 0;
+        END
+        """,
+        """
+        CREATE TRIGGER katas_stats_difficulty AFTER UPDATE OF difficulty ON katas WHEN old.difficulty IS NOT new.difficulty
+        BEGIN
+            UPDATE topic_stats SET katas = katas - 1
+                WHERE old.difficulty != '' AND difficulty = old.difficulty AND topic_id IN (SELECT topic_id FROM kata_topics WHERE kata_id = new.id);
+            DELETE FROM topic_stats WHERE difficulty = old.difficulty AND katas <= 0;
+            INSERT INTO topic_stats (topic_id, difficulty, katas)
+                SELECT topic_id, new.difficulty, 1 FROM kata_topics WHERE kata_id = new.id AND new.difficulty != ''
+                ON CONFLICT (topic_id, difficulty) DO UPDATE SET katas = katas + 1;
+        END
+        """,
+    ],
+]
+
+def migrate(conn):
+    """Apply the migrations this database hasn't seen yet, each in its own transaction."""
+    conn.isolation_level = None  # Manage transactions explicitly so DDL is covered too
+    while True:
+        conn.execute("BEGIN IMMEDIATE")  # Serializes concurrent workers starting up
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.execute("COMMIT")
+                return
+            step = MIGRATIONS[version]
+            cursor = conn.cursor()
+            if callable(step):
+                step(cursor)
+            else:
+                for statement in step:
+                    cursor.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
 
 def init_db():
+    """Create the tables and apply pending migrations. Cheap once the database is current."""
     with sqlite3.connect(DATABASE) as conn:
         cursor = conn.cursor()
+        # Every schema change since these tables is a migration, so a database
+        # at the latest version needs no DDL (and no write lock) at all
+        if cursor.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+            return
+        if READ_ONLY:
+            raise RuntimeError("The database schema is out of date; start a read-write process once to migrate it.")
+        # WAL is persistent, so setting it once here covers every later connection
+        cursor.execute("PRAGMA journal_mode=WAL")
         # Create users table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -26,10 +218,15 @@ def init_db():
                 difficulty TEXT,
                 completion_time TEXT,
                 topics_text TEXT,
+                html_content TEXT,
+                html_hash TEXT,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL, -- Added NOT NULL
                 FOREIGN KEY (author_id) REFERENCES users (id)
             )
         ''')
+        # Columns added after the katas table was first deployed
+        add_column_if_missing(cursor, 'katas', 'html_content', 'TEXT')
+        add_column_if_missing(cursor, 'katas', 'html_hash', 'TEXT')
         # Create topics table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS topics (
@@ -84,35 +281,175 @@ def init_db():
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
         ''')
-        # Create FTS5 table for katas
+        # Create import_jobs table for bulk uploads processed in the background
         cursor.execute('''
-            CREATE VIRTUAL TABLE IF NOT EXISTS katas_fts USING fts5(title, content, topics_text);
-        '''
-        )
-        # Triggers to keep FTS table in sync with katas table
+            CREATE TABLE IF NOT EXISTS import_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued', -- queued, running, done, failed
+                sources TEXT NOT NULL, -- JSON list of [name, spooled file path]
+                processed INTEGER DEFAULT 0, -- rows consumed so far, for resuming
+                uploaded INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                errors TEXT DEFAULT '[]',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        # Similar katas: document frequencies, per-kata top terms and precomputed neighbors
         cursor.execute('''
-            CREATE TRIGGER IF NOT EXISTS katas_after_insert AFTER INSERT ON katas
-            BEGIN
-                INSERT INTO katas_fts (rowid, title, content, topics_text) VALUES (new.id, new.title, new.content, new.topics_text);
-            END;
+            CREATE TABLE IF NOT EXISTS similar_terms (
+                term TEXT PRIMARY KEY,
+                df INTEGER NOT NULL
+            ) WITHOUT ROWID
         ''')
         cursor.execute('''
-            CREATE TRIGGER IF NOT EXISTS katas_after_delete AFTER DELETE ON katas
-            BEGIN
-                DELETE FROM katas_fts WHERE rowid = old.id;
-            END;
+            CREATE TABLE IF NOT EXISTS kata_terms (
+                kata_id INTEGER NOT NULL,
+                term TEXT NOT NULL,
+                weight REAL NOT NULL,
+                PRIMARY KEY (kata_id, term),
+                FOREIGN KEY (kata_id) REFERENCES katas (id)
+            ) WITHOUT ROWID
         ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_kata_terms_term ON kata_terms (term)")
         cursor.execute('''
-            CREATE TRIGGER IF NOT EXISTS katas_after_update AFTER UPDATE ON katas
-            BEGIN
-                UPDATE katas_fts SET title = new.title, content = new.content, topics_text = new.topics_text WHERE rowid = new.id;
-            END;
+            CREATE TABLE IF NOT EXISTS kata_neighbors (
+                kata_id INTEGER NOT NULL,
+                rank INTEGER NOT NULL,
+                neighbor_id INTEGER NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (kata_id, rank),
+                FOREIGN KEY (kata_id) REFERENCES katas (id),
+                FOREIGN KEY (neighbor_id) REFERENCES katas (id)
+            ) WITHOUT ROWID
         ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_kata_neighbors_neighbor ON kata_neighbors (neighbor_id)")
+        # Near-duplicate detection: MinHash signatures and their LSH band buckets
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS kata_minhash (
+                kata_id INTEGER PRIMARY KEY,
+                signature BLOB NOT NULL,
+                FOREIGN KEY (kata_id) REFERENCES katas (id)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS kata_lsh (
+                bucket INTEGER NOT NULL,
+                kata_id INTEGER NOT NULL,
+                PRIMARY KEY (bucket, kata_id),
+                FOREIGN KEY (kata_id) REFERENCES katas (id)
+            ) WITHOUT ROWID
+        ''')
+        # Full-text index over katas; external content, so the text itself is only stored once
+        cursor.execute(KATAS_FTS_SCHEMA)
+        for trigger in KATAS_FTS_TRIGGERS:
+            cursor.execute(trigger.replace("CREATE TRIGGER", "CREATE TRIGGER IF NOT EXISTS", 1))
+        # A single counter bumped on every change that can show up on a page, used
+        # as the validator for HTTP caching of listings
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cache_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                generation INTEGER NOT NULL DEFAULT 0,
+                updated_at INTEGER NOT NULL -- unix time of the last change
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO cache_state (id, generation, updated_at) VALUES (1, 0, CAST(strftime('%s', 'now') AS INTEGER))")
+        for table in ('katas', 'kata_topics', 'user_kata_actions', 'user_kata_notes', 'users'):
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_bump_cache_{event.lower()} AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE cache_state SET generation = generation + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE id = 1;
+                    END;
+                ''')
+        conn.commit()
+        migrate(conn)
 
-def get_db():
-    conn = sqlite3.connect(DATABASE)
+def connect():
+    """Open a new connection with the per-connection settings applied."""
+    conn = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False, factory=InstrumentedConnection)
     conn.row_factory = sqlite3.Row  # This allows accessing columns by name
+    if READ_ONLY:
+        conn.execute("PRAGMA query_only=ON")
+    else:
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
-# Call init_db() when this module is imported to ensure tables are created
-init_db()
+class ConnectionPool:
+    """A bounded set of connections shared by the worker threads of one process.
+
+    Connections are opened as concurrent demand first needs them, so a fresh
+    worker answers its first request after opening just one.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if can_open:
+            try:
+                return connect()
+            except BaseException:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        try:
+            return self._idle.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError('Timed out waiting for a database connection.')
+
+    def release(self, conn):
+        # Never hand a connection with a half-finished transaction to the next request
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    # A forked worker must not share the parent's sqlite handles
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(POOL_SIZE)
+    return _pool
+
+def get_db():
+    """Return the request's connection, borrowing one from the pool on first use.
+
+    Outside of an app context (scripts, background threads) a standalone
+    connection is returned and the caller is responsible for closing it.
+    """
+    if not has_app_context():
+        return connect()
+    db = getattr(g, '_database', None)
+    if db is None:
+        db = g._database = get_pool().acquire()
+    return db
+
+def release_db(conn):
+    get_pool().release(conn)
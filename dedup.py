@@ -0,0 +1,162 @@
+"""Near-duplicate detection for katas with MinHash signatures and LSH buckets.
+
+A kata's title and content are shingled into word 3-grams and summarized by
+a NUM_PERM value MinHash signature. The signature is cut into BANDS bands,
+each hashed to a bucket in kata_lsh. Katas sharing any bucket are
+candidates, and a candidate counts as a duplicate when the share of equal
+signature values (an estimate of Jaccard similarity) reaches
+DUPLICATE_THRESHOLD. Lookups touch BANDS index entries however large the
+corpus is.
+"""
+import hashlib
+import json
+import random
+import re
+import zlib
+from array import array
+
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+DUPLICATE_THRESHOLD = 0.8
+# Buckets bigger than this are skipped when clustering the whole corpus
+MAX_BUCKET_SIZE = 200
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_rng = random.Random(1729)  # Fixed seed: stored signatures must stay comparable
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(NUM_PERM)]
+
+WORD_RE = re.compile(r'\w+')
+
+
+def shingles(title, content):
+    words = WORD_RE.findall(f"{title or ''} {content or ''}".lower())
+    if len(words) < SHINGLE_SIZE:
+        return {' '.join(words)}
+    return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def signature(title, content):
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(title, content)]
+    return array('I', (min(((a * x + b) % _MERSENNE_PRIME) & _MAX_HASH for x in hashes) for a, b in _PERMUTATIONS))
+
+
+def similarity(signature_a, signature_b):
+    return sum(1 for x, y in zip(signature_a, signature_b) if x == y) / NUM_PERM
+
+
+def buckets(sig):
+    """One bucket id per band; the band index is hashed in so bands never collide."""
+    result = []
+    for band in range(BANDS):
+        rows = sig[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND].tobytes()
+        digest = hashlib.blake2b(bytes([band]) + rows, digest_size=8).digest()
+        result.append(int.from_bytes(digest, 'big', signed=True))
+    return result
+
+
+def find_duplicate(cursor, sig):
+    """Return (kata_id, similarity) of the closest stored near-duplicate of `sig`, or None."""
+    cursor.execute("""
+        SELECT m.kata_id, m.signature FROM kata_minhash m
+        WHERE m.kata_id IN (SELECT kata_id FROM kata_lsh WHERE bucket IN (SELECT value FROM json_each(?)))
+    """, (json.dumps(buckets(sig)),))
+    best = None
+    for kata_id, stored in cursor.fetchall():
+        score = similarity(sig, array('I', stored))
+        if score >= DUPLICATE_THRESHOLD and (best is None or score > best[1]):
+            best = (kata_id, score)
+    return best
+
+
+def add_kata(cursor, kata_id, sig):
+    cursor.execute("INSERT OR REPLACE INTO kata_minhash (kata_id, signature) VALUES (?, ?)", (kata_id, sig.tobytes()))
+    cursor.executemany("INSERT OR IGNORE INTO kata_lsh (bucket, kata_id) VALUES (?, ?)", [(bucket, kata_id) for bucket in buckets(sig)])
+
+
+def remove_kata(cursor, kata_id):
+    cursor.execute("SELECT signature FROM kata_minhash WHERE kata_id = ?", (kata_id,))
+    row = cursor.fetchone()
+    if row is not None:
+        cursor.executemany("DELETE FROM kata_lsh WHERE bucket = ? AND kata_id = ?",
+                           [(bucket, kata_id) for bucket in buckets(array('I', row[0]))])
+        cursor.execute("DELETE FROM kata_minhash WHERE kata_id = ?", (kata_id,))
+
+
+class PendingBuckets:
+    """In-memory LSH over katas not yet written, to catch duplicates within one upload."""
+
+    def __init__(self):
+        self._buckets = {}
+
+    def find(self, sig):
+        for bucket in buckets(sig):
+            for key, other in self._buckets.get(bucket, ()):
+                if similarity(sig, other) >= DUPLICATE_THRESHOLD:
+                    return key
+        return None
+
+    def add(self, key, sig):
+        for bucket in buckets(sig):
+            self._buckets.setdefault(bucket, []).append((key, sig))
+
+
+def index_missing(db):
+    """Compute signatures for katas that don't have one yet (e.g. created before dedup existed)."""
+    read_cursor = db.cursor()
+    write_cursor = db.cursor()
+    read_cursor.execute("SELECT id, title, content FROM katas WHERE id NOT IN (SELECT kata_id FROM kata_minhash)")
+    indexed = 0
+    while True:
+        rows = read_cursor.fetchmany(500)
+        if not rows:
+            break
+        for kata_id, title, content in rows:
+            add_kata(write_cursor, kata_id, signature(title, content))
+        indexed += len(rows)
+    db.commit()
+    return indexed
+
+
+def find_clusters(db):
+    """Group the whole corpus into clusters of near-duplicates (lists of kata ids, size >= 2)."""
+    cursor = db.cursor()
+    signatures = {kata_id: array('I', stored) for kata_id, stored in cursor.execute("SELECT kata_id, signature FROM kata_minhash")}
+
+    parent = {}
+
+    def find(x):
+        while parent.get(x, x) != x:
+            parent[x] = parent.get(parent[x], parent[x])
+            x = parent[x]
+        return x
+
+    def union(x, y):
+        root_x, root_y = find(x), find(y)
+        parent.setdefault(root_x, root_x)
+        parent.setdefault(root_y, root_y)
+        if root_x != root_y:
+            parent[max(root_x, root_y)] = min(root_x, root_y)
+
+    def check_bucket(members):
+        if len(members) < 2 or len(members) > MAX_BUCKET_SIZE:
+            return
+        for i, kata_id in enumerate(members):
+            for other_id in members[i + 1:]:
+                if find(kata_id) != find(other_id) and similarity(signatures[kata_id], signatures[other_id]) >= DUPLICATE_THRESHOLD:
+                    union(kata_id, other_id)
+
+    current_bucket, members = None, []
+    for bucket, kata_id in cursor.execute("SELECT bucket, kata_id FROM kata_lsh ORDER BY bucket"):
+        if bucket != current_bucket:
+            check_bucket(members)
+            current_bucket, members = bucket, []
+        members.append(kata_id)
+    check_bucket(members)
+
+    clusters = {}
+    for kata_id in parent:
+        clusters.setdefault(find(kata_id), []).append(kata_id)
+    return sorted((sorted(ids) for ids in clusters.values() if len(ids) > 1), key=len, reverse=True)
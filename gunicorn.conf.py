@@ -0,0 +1,28 @@
+"""gunicorn settings; run with `gunicorn -c gunicorn.conf.py wsgi:app`.
+
+Environment: PORT or BIND, WEB_CONCURRENCY (worker processes), and
+DB_POOL_SIZE, which also sets the threads per worker so every thread can
+hold a pooled connection. READ_ONLY=1 serves reads only (see database.py).
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', 8000)}")
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('DB_POOL_SIZE', 8))
+
+# Import the app (and migrate the schema) once in the master; workers are forks of it
+preload_app = True
+
+# Recycle workers regularly; a replacement is a fork, so it is serving within milliseconds
+max_requests = int(os.environ.get('MAX_REQUESTS', 2000))
+max_requests_jitter = max_requests // 10
+graceful_timeout = 10
+timeout = 30
+keepalive = 5
+
+
+def when_ready(server):
+    import wsgi
+    server.log.info(f"App loaded in {wsgi.STARTUP_SECONDS * 1000:.0f} ms")
@@ -0,0 +1,347 @@
+"""MCP (Model Context Protocol) server exposing the kata database over stdio.
+
+    python mcp_server.py --db database.db [--user SECRET_USERNAME]
+
+Tools: search_katas, get_katas, similar_katas, related_katas, list_topics and
+compile_prompt (the same [[ placeholders ]] as the site; the "your_..." ones
+need --user). Messages are newline-delimited JSON-RPC 2.0 on stdin/stdout,
+handled one at a time, so a single long-lived read-only connection is the
+whole pool. Results are kept in an in-memory LRU that is dropped whenever
+the app bumps cache_state, so repeated calls from an agent loop are served
+from memory and a changed database is never served stale.
+
+Nothing here imports Flask: startup is opening one SQLite file.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+
+import similar
+from search import RELEVANCE_SQL, fts_query, plain, snippets
+from prompts import (ALLOWED_COMPLETION_TIMES, ALLOWED_DIFFICULTIES, RECENT_KATA_PLACEHOLDERS, build_kata_export_payload,
+                     compile_prompt_text, recent_kata_ids, recent_kata_values)
+
+SERVER_NAME = 'ml-katas'
+SERVER_VERSION = '1'
+PROTOCOL_VERSIONS = ('2025-06-18', '2025-03-26', '2024-11-05')  # Newest first
+RESULT_CACHE_ENTRIES = int(os.environ.get('MCP_CACHE_ENTRIES', 1024))
+SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+MAX_FETCH_IDS = 100
+RELATED_LIMIT = 10
+TOPICS_LIMIT = 100
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 64 * 1024
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+
+SUMMARY_COLUMNS = "k.id, k.title, k.difficulty, k.completion_time, k.upvotes, k.saves, k.completions, k.created_at"
+
+
+class ToolError(Exception):
+    """A problem with a tool call, reported back to the model rather than as a protocol error."""
+
+
+def connect_readonly(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No database at {path}; start the app once to create it.")
+    conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA query_only=ON")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KIB}")
+    return conn
+
+
+def _int_arg(args, name, default=None, low=1, high=None):
+    value = args.get(name, default)
+    if not isinstance(value, int) or isinstance(value, bool) or value < low or (high is not None and value > high):
+        raise ToolError(f"{name} must be an integer between {low} and {high}." if high else f"{name} must be a positive integer.")
+    return value
+
+
+def _choice_arg(args, name, choices):
+    value = args.get(name)
+    if value is not None and value not in choices:
+        raise ToolError(f"{name} must be one of {', '.join(choices)}.")
+    return value
+
+
+class KataTools:
+    def __init__(self, conn, user_id=None):
+        self.conn = conn
+        self.user_id = user_id
+        self._results = OrderedDict()  # (tool, arguments) -> result text
+        self._state = None
+
+    def call(self, name, args):
+        """Run a tool, answering from the result cache while the database is unchanged."""
+        state = tuple(self.conn.execute("SELECT generation, accounts_generation FROM cache_state WHERE id = 1").fetchone())
+        if state != self._state:
+            self._results.clear()
+            self._state = state
+        key = (name, json.dumps(args, sort_keys=True))
+        text = self._results.get(key)
+        if text is None:
+            result = getattr(self, name)(args)
+            text = result if isinstance(result, str) else json.dumps(result, default=str)
+            self._results[key] = text
+            if len(self._results) > RESULT_CACHE_ENTRIES:
+                self._results.popitem(last=False)
+        else:
+            self._results.move_to_end(key)
+        return text
+
+    def _topics_by_kata(self, kata_ids):
+        topics_by_kata = {}
+        rows = self.conn.execute("SELECT kt.kata_id, t.name FROM kata_topics kt JOIN topics t ON t.id = kt.topic_id WHERE kt.kata_id IN (SELECT value FROM json_each(?))",
+                                 (json.dumps(kata_ids),))
+        for row in rows:
+            topics_by_kata.setdefault(row['kata_id'], []).append(row['name'])
+        return topics_by_kata
+
+    def _summaries(self, rows):
+        katas = [dict(row) for row in rows]
+        topics_by_kata = self._topics_by_kata([kata['id'] for kata in katas])
+        for kata in katas:
+            kata['topics'] = topics_by_kata.get(kata['id'], [])
+        return katas
+
+    def _load_katas(self, kata_ids):
+        """Full katas by id, with topics and, when a user is set, their actions and note."""
+        ids = json.dumps(kata_ids)
+        rows = self.conn.execute("SELECT k.*, u.display_name AS author_display_name FROM katas k JOIN users u ON k.author_id = u.id WHERE k.id IN (SELECT value FROM json_each(?))",
+                                 (ids,))
+        katas = {row['id']: dict(row) for row in rows}
+        topics_by_kata = self._topics_by_kata(kata_ids)
+        actions_by_kata, notes_by_kata = {}, {}
+        if self.user_id:
+            for row in self.conn.execute("SELECT kata_id, action_type FROM user_kata_actions WHERE user_id = ? AND kata_id IN (SELECT value FROM json_each(?))",
+                                         (self.user_id, ids)):
+                actions_by_kata.setdefault(row['kata_id'], set()).add(row['action_type'])
+            notes_by_kata = {row['kata_id']: row['content'] for row in self.conn.execute(
+                "SELECT kata_id, content FROM user_kata_notes WHERE user_id = ? AND kata_id IN (SELECT value FROM json_each(?))", (self.user_id, ids))}
+        for kata in katas.values():
+            kata['topics'] = topics_by_kata.get(kata['id'], [])
+            kata_actions = actions_by_kata.get(kata['id'], ())
+            kata['is_upvoted'] = 'upvote' in kata_actions
+            kata['is_saved'] = 'save' in kata_actions
+            kata['is_completed'] = 'complete' in kata_actions
+            kata['user_note'] = notes_by_kata.get(kata['id'])
+        return katas
+
+    def search_katas(self, args):
+        query = args.get('query') or ''
+        if not isinstance(query, str):
+            raise ToolError("query must be a string.")
+        limit = _int_arg(args, 'limit', SEARCH_LIMIT, 1, MAX_SEARCH_LIMIT)
+        conditions, params = [], []
+        for name, choices in (('difficulty', ALLOWED_DIFFICULTIES), ('completion_time', ALLOWED_COMPLETION_TIMES)):
+            value = _choice_arg(args, name, choices)
+            if value:
+                conditions.append(f"k.{name} = ?")
+                params.append(value)
+        if args.get('topic'):
+            conditions.append("k.id IN (SELECT kt.kata_id FROM kata_topics kt JOIN topics t ON kt.topic_id = t.id WHERE t.name = ?)")
+            params.append(args['topic'])
+
+        match = fts_query(query)
+        if match:
+            sql = f"SELECT {SUMMARY_COLUMNS}, {RELEVANCE_SQL} AS relevance FROM katas_fts JOIN katas k ON k.id = katas_fts.rowid WHERE katas_fts MATCH ?"
+            params.insert(0, match)
+            order = "relevance"
+        else:
+            sql = f"SELECT {SUMMARY_COLUMNS} FROM katas k WHERE 1"
+            order = "k.created_at DESC, k.id DESC"
+        for condition in conditions:
+            sql += " AND " + condition
+        sql += f" ORDER BY {order} LIMIT ?"
+        params.append(limit)
+        katas = self._summaries(self.conn.execute(sql, params).fetchall())
+        if match and katas:
+            excerpts = snippets(self.conn.cursor(), match, [kata['id'] for kata in katas], render=plain)
+            for kata in katas:
+                kata['snippet'] = excerpts.get(kata['id'])
+        return katas
+
+    def get_katas(self, args):
+        ids = args.get('ids')
+        if not isinstance(ids, list) or not ids or len(ids) > MAX_FETCH_IDS or not all(isinstance(i, int) for i in ids):
+            raise ToolError(f"ids must be a list of 1 to {MAX_FETCH_IDS} kata ids.")
+        katas = self._load_katas(ids)
+        return [build_kata_export_payload(katas[kata_id], include_user_state=bool(self.user_id))
+                for kata_id in ids if kata_id in katas]
+
+    def similar_katas(self, args):
+        kata_id = _int_arg(args, 'kata_id')
+        return [dict(row) for row in similar.get_similar_katas(self.conn, kata_id)]
+
+    def related_katas(self, args):
+        kata_id = _int_arg(args, 'kata_id')
+        limit = _int_arg(args, 'limit', RELATED_LIMIT, 1, MAX_SEARCH_LIMIT)
+        rows = self.conn.execute(f"""
+            SELECT {SUMMARY_COLUMNS}, COUNT(*) AS shared_topics
+            FROM kata_topics mine
+            JOIN kata_topics other ON other.topic_id = mine.topic_id AND other.kata_id != mine.kata_id
+            JOIN katas k ON k.id = other.kata_id
+            WHERE mine.kata_id = ?
+            GROUP BY other.kata_id
+            ORDER BY shared_topics DESC, k.upvotes DESC
+            LIMIT ?
+        """, (kata_id, limit)).fetchall()
+        return self._summaries(rows)
+
+    def list_topics(self, args):
+        limit = _int_arg(args, 'limit', TOPICS_LIMIT, 1, 1000)
+        # The counts the web facets read too, kept current by triggers
+        rows = self.conn.execute("""
+            SELECT t.name, s.katas FROM topic_stats s JOIN topics t ON t.id = s.topic_id
+            WHERE s.difficulty = '' ORDER BY s.katas DESC LIMIT ?
+        """, (limit,))
+        return [dict(row) for row in rows]
+
+    def compile_prompt(self, args):
+        prompt = args.get('prompt')
+        if not isinstance(prompt, str) or not prompt:
+            raise ToolError("prompt is required.")
+        return compile_prompt_text(prompt, self.user_id, self._resolve_recent)
+
+    def _resolve_recent(self, names, user_id):
+        if not user_id:
+            return {name: '[]' for name in names}
+        ids_by_action = recent_kata_ids(self.conn.cursor(), user_id, names)
+        all_ids = sorted({kata_id for ids in ids_by_action.values() for kata_id in ids})
+        return recent_kata_values(names, ids_by_action, self._load_katas(all_ids))
+
+
+def _schema(properties=None, required=()):
+    return {'type': 'object', 'properties': properties or {}, 'required': list(required)}
+
+
+KATA_ID = {'type': 'integer', 'description': 'Kata id.'}
+LIMIT = {'type': 'integer', 'minimum': 1, 'maximum': MAX_SEARCH_LIMIT}
+
+# Tool name -> (description, input schema); each is a KataTools method of the same name
+TOOLS = {
+    'search_katas': ("Full-text search over kata titles, content and topics (stemmed, prefix matching), best matches first, "
+                     "with optional filters. Without a query, lists the newest katas. Returns summaries and a matching excerpt, not content.",
+                     _schema({'query': {'type': 'string'},
+                              'difficulty': {'type': 'string', 'enum': ALLOWED_DIFFICULTIES},
+                              'completion_time': {'type': 'string', 'enum': ALLOWED_COMPLETION_TIMES},
+                              'topic': {'type': 'string', 'description': 'Exact topic name.'},
+                              'limit': LIMIT})),
+    'get_katas': ("Fetch full katas (markdown content, topics, stats) by id, in the order given.",
+                  _schema({'ids': {'type': 'array', 'items': {'type': 'integer'}, 'maxItems': MAX_FETCH_IDS}}, ['ids'])),
+    'similar_katas': ("Katas whose content is most similar to the given kata (TF-IDF neighbors, with scores).",
+                      _schema({'kata_id': KATA_ID}, ['kata_id'])),
+    'related_katas': ("Katas sharing the most topics with the given kata.",
+                      _schema({'kata_id': KATA_ID, 'limit': LIMIT}, ['kata_id'])),
+    'list_topics': ("Topics by number of katas.",
+                    _schema({'limit': {'type': 'integer', 'minimum': 1, 'maximum': 1000}})),
+    'compile_prompt': ("Expand the site's prompt placeholders: [[ allowed_difficulties ]], [[ allowed_times ]], "
+                       "[[ schema_details ]] and " + ', '.join(f'[[ {name} ]]' for name in RECENT_KATA_PLACEHOLDERS) + ".",
+                       _schema({'prompt': {'type': 'string'}}, ['prompt'])),
+}
+
+
+class Server:
+    def __init__(self, tools):
+        self.tools = tools
+        self.methods = {
+            'initialize': self.initialize,
+            'ping': lambda params: {},
+            'tools/list': self.list_tools,
+            'tools/call': self.call_tool,
+        }
+
+    def initialize(self, params):
+        requested = params.get('protocolVersion')
+        return {
+            'protocolVersion': requested if requested in PROTOCOL_VERSIONS else PROTOCOL_VERSIONS[0],
+            'capabilities': {'tools': {'listChanged': False}},
+            'serverInfo': {'name': SERVER_NAME, 'version': SERVER_VERSION},
+        }
+
+    def list_tools(self, params):
+        return {'tools': [{'name': name, 'description': description, 'inputSchema': schema}
+                          for name, (description, schema) in TOOLS.items()]}
+
+    def call_tool(self, params):
+        name = params.get('name')
+        if name not in TOOLS:
+            raise ValueError(f"Unknown tool: {name}")
+        try:
+            text = self.tools.call(name, params.get('arguments') or {})
+        except (ToolError, sqlite3.Error) as exc:
+            return {'content': [{'type': 'text', 'text': str(exc)}], 'isError': True}
+        return {'content': [{'type': 'text', 'text': text}], 'isError': False}
+
+    def handle(self, message):
+        """Answer one JSON-RPC message; notifications (no id) get None."""
+        if not isinstance(message, dict) or message.get('jsonrpc') != '2.0' or not isinstance(message.get('method'), str):
+            return _error(message.get('id') if isinstance(message, dict) else None, INVALID_REQUEST, 'Invalid request')
+        if 'id' not in message:
+            return None
+        method = self.methods.get(message['method'])
+        if method is None:
+            return _error(message['id'], METHOD_NOT_FOUND, f"Method not found: {message['method']}")
+        params = message.get('params') or {}
+        try:
+            result = method(params)
+        except (ValueError, AttributeError) as exc:
+            return _error(message['id'], INVALID_PARAMS, str(exc))
+        return {'jsonrpc': '2.0', 'id': message['id'], 'result': result}
+
+
+def _error(message_id, code, text):
+    return {'jsonrpc': '2.0', 'id': message_id, 'error': {'code': code, 'message': text}}
+
+
+def serve(server, stdin, stdout):
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            message = json.loads(line)
+        except ValueError:
+            response = _error(None, PARSE_ERROR, 'Parse error')
+        else:
+            if isinstance(message, list):  # A batch (protocol revision 2025-03-26)
+                response = [reply for reply in map(server.handle, message) if reply is not None] or None
+            else:
+                response = server.handle(message)
+        if response is not None:
+            stdout.write(json.dumps(response, separators=(',', ':')) + '\n')
+            stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--db', default=os.environ.get('DATABASE_PATH', 'database.db'))
+    parser.add_argument('--user', default=os.environ.get('MLKATAS_USER'),
+                        help="Secret username whose saved/upvoted/completed katas fill the your_... placeholders.")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    conn = connect_readonly(args.db)
+    user_id = None
+    if args.user:
+        row = conn.execute("SELECT id FROM users WHERE secret_username = ?", (args.user,)).fetchone()
+        if row is None:
+            parser.error("No user with that secret username.")
+        user_id = row['id']
+    # stdout carries the protocol; anything else goes to stderr
+    print(f"{SERVER_NAME} MCP server ready on {args.db} in {(time.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
+    serve(Server(KataTools(conn, user_id)), sys.stdin, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Query and request instrumentation, exported in Prometheus text format.
+
+Connections opened by database.connect() use InstrumentedConnection, whose
+cursors time every statement (and the fetches that finish it) into the
+RequestStats of the request being served, if any. Statements slower than
+SLOW_QUERY_MS are kept, with their query plan, in a small ring buffer.
+Everything is per process; scrape each worker.
+"""
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 50))
+SLOW_QUERY_SAMPLES = 50
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+_current = contextvars.ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+
+
+def start_request():
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.request_seconds = Histogram(LATENCY_BUCKETS)
+        self.request_queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.sql_queries = {}   # route -> statements run
+        self.sql_seconds = {}   # route -> seconds spent in SQL
+        self.slow_queries = deque(maxlen=SLOW_QUERY_SAMPLES)
+
+    def record_request(self, route, method, status, stats):
+        elapsed = time.perf_counter() - stats.started
+        with self.lock:
+            self.request_seconds.observe((route, method, str(status)), elapsed)
+            self.request_queries.observe((route,), stats.queries)
+            self.sql_queries[route] = self.sql_queries.get(route, 0) + stats.queries
+            self.sql_seconds[route] = self.sql_seconds.get(route, 0.0) + stats.sql_seconds
+        return elapsed
+
+    def render(self, extra_gauges=()):
+        lines = []
+        with self.lock:
+            _render_histogram(lines, 'app_request_duration_seconds', 'Request latency by route.',
+                              ('route', 'method', 'status'), self.request_seconds)
+            _render_histogram(lines, 'app_request_sql_queries', 'SQL statements run per request.',
+                              ('route',), self.request_queries)
+            lines.append('# HELP app_sql_queries_total SQL statements run, by route.')
+            lines.append('# TYPE app_sql_queries_total counter')
+            for route, value in sorted(self.sql_queries.items()):
+                lines.append(f'app_sql_queries_total{{route="{_escape(route)}"}} {value}')
+            lines.append('# HELP app_sql_seconds_total Time spent in SQL, by route.')
+            lines.append('# TYPE app_sql_seconds_total counter')
+            for route, value in sorted(self.sql_seconds.items()):
+                lines.append(f'app_sql_seconds_total{{route="{_escape(route)}"}} {value:.6f}')
+            lines.append('# HELP app_slow_queries_sampled Slow query samples currently held.')
+            lines.append('# TYPE app_slow_queries_sampled gauge')
+            lines.append(f'app_slow_queries_sampled {len(self.slow_queries)}')
+        for name, help_text, value in extra_gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def slow_query_samples(self):
+        with self.lock:
+            return list(self.slow_queries)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _render_histogram(lines, name, help_text, label_names, histogram):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for labels, series in sorted(histogram.series.items()):
+        label_text = ','.join(f'{key}="{_escape(value)}"' for key, value in zip(label_names, labels))
+        for bound, count in zip(histogram.buckets, series):
+            lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{label_text},le="+Inf"}} {series[-1]}')
+        lines.append(f'{name}_sum{{{label_text}}} {series[-2]:.6f}')
+        lines.append(f'{name}_count{{{label_text}}} {series[-1]}')
+
+
+registry = Registry()
+
+
+def _record(cursor, sql, params, elapsed, count=True):
+    stats = _current.get()
+    if stats is not None:
+        if count:
+            stats.queries += 1
+        stats.sql_seconds += elapsed
+    if sql is not None and elapsed * 1000 >= SLOW_QUERY_MS:
+        try:
+            # The uninstrumented execute, so explaining a slow query can't recurse
+            plan = [row[3] for row in sqlite3.Connection.execute(cursor.connection, "EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        except sqlite3.Error:
+            plan = []
+        # Parameters are left out: they can hold secrets such as usernames
+        with registry.lock:
+            registry.slow_queries.append({'sql': ' '.join(sql.split()), 'ms': round(elapsed * 1000, 2),
+                                          'plan': plan, 'at': time.time()})
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            _record(self, sql, params, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            _record(self, None, None, time.perf_counter() - started)
+
+    def executescript(self, script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            _record(self, None, None, time.perf_counter() - started)
+
+    # Most of a SELECT's work happens while stepping through its rows
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            _record(self, None, None, time.perf_counter() - started, count=False)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            _record(self, None, None, time.perf_counter() - started, count=False)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _record(self, None, None, time.perf_counter() - started, count=False)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # The C implementations of these shortcuts don't go through cursor()
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def executescript(self, script):
+        return self.cursor().executescript(script)
@@ -0,0 +1,165 @@
+"""Rendered page cache for anonymous views.
+
+Pages are keyed by their ETag, which already folds in the cache generation
+(or, for kata pages, the kata's own validator row), so any change to what a
+page shows moves it to a new key and stale entries simply age out. The
+in-process LRU is bounded by entry count, total bytes and TTL; setting
+PAGE_CACHE_PATH switches to a SQLite file shared by every worker.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+PAGE_CACHE_ENTRIES = int(os.environ.get('PAGE_CACHE_ENTRIES', 512))
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 300))
+PAGE_CACHE_PATH = os.environ.get('PAGE_CACHE_PATH')
+
+
+class MemoryPageCache:
+    """Per-process LRU of page bodies."""
+
+    backend = 'memory'
+
+    def __init__(self, max_entries=PAGE_CACHE_ENTRIES, max_bytes=PAGE_CACHE_MAX_BYTES, ttl=PAGE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, body)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, body)
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _drop(self, key):
+        _, body = self._entries.pop(key)
+        self._bytes -= len(body)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': self.backend, 'entries': len(self._entries), 'bytes': self._bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class SqlitePageCache:
+    """Page bodies in a SQLite file, shared by every worker on the host.
+
+    Hit/miss counters are per process; entries and bytes are for the whole file.
+    """
+
+    backend = 'sqlite'
+
+    def __init__(self, path, max_entries=PAGE_CACHE_ENTRIES, max_bytes=PAGE_CACHE_MAX_BYTES, ttl=PAGE_CACHE_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        with self._connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS pages (
+                    key TEXT PRIMARY KEY,
+                    body BLOB NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_pages_accessed_at ON pages (accessed_at)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=1)
+            self._local.pid = os.getpid()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")  # It's a cache; losing it on a crash is fine
+        return conn
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key):
+        now = time.time()
+        try:
+            with self._connection() as conn:
+                row = conn.execute("SELECT body FROM pages WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE pages SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.OperationalError:  # Busy or locked: treat as a miss rather than fail the request
+            row = None
+        self._count('misses' if row is None else 'hits')
+        return None if row is None else row[0]
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        now = time.time()
+        try:
+            with self._connection() as conn:
+                conn.execute("INSERT OR REPLACE INTO pages (key, body, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                             (key, body, now + self.ttl, now))
+                conn.execute("DELETE FROM pages WHERE expires_at <= ?", (now,))
+                # Evict least recently used entries beyond the bounds
+                evicted = conn.execute('''
+                    DELETE FROM pages WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key,
+                                   ROW_NUMBER() OVER (ORDER BY accessed_at DESC) AS position,
+                                   SUM(length(body)) OVER (ORDER BY accessed_at DESC) AS running_bytes
+                            FROM pages
+                        )
+                        WHERE position > ? OR running_bytes > ?
+                    )
+                ''', (self.max_entries, self.max_bytes)).rowcount
+        except sqlite3.OperationalError:
+            return
+        with self._lock:
+            self.evictions += evicted
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM pages")
+
+    def stats(self):
+        with self._connection() as conn:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(length(body)), 0) FROM pages").fetchone()
+        with self._lock:
+            return {'backend': self.backend, 'entries': entries, 'bytes': size,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+page_cache = SqlitePageCache(PAGE_CACHE_PATH) if PAGE_CACHE_PATH else MemoryPageCache()
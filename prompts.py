@@ -0,0 +1,107 @@
+"""Prompt placeholders and the kata JSON they expand to.
+
+Placeholders are written as [[ name ]] in a prompt. Simple ones map to a
+function of the user id; the "recent katas" ones are resolved together by
+the caller from recent_kata_ids(), so a prompt using all of them still costs
+a fixed handful of queries. Shared by the web app and the MCP server, so
+nothing here imports Flask.
+"""
+import json
+import os
+import re
+from functools import lru_cache
+
+ALLOWED_COMPLETION_TIMES = ['<10 mins', '<30 mins', '<1 hr', '>1 hr']
+ALLOWED_DIFFICULTIES = ['easy', 'medium', 'hard']
+SCHEMA_DETAILS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'kata_schema.txt')
+
+
+@lru_cache(maxsize=None)
+def schema_details():
+    with open(SCHEMA_DETAILS_PATH, 'r', encoding='utf-8') as schema_file:
+        return schema_file.read().strip()
+
+
+PROMPT_PLACEHOLDER_RE = re.compile(r'\[\[ (\w+) \]\]')
+PROMPT_PLACEHOLDERS = {
+    'allowed_difficulties': lambda user_id: ', '.join(ALLOWED_DIFFICULTIES),
+    'allowed_times': lambda user_id: ', '.join(ALLOWED_COMPLETION_TIMES),
+    'schema_details': lambda user_id: schema_details(),
+}
+RECENT_KATA_PLACEHOLDERS = {
+    'your_10_last_upvoted': 'upvote',
+    'your_10_last_saved': 'save',
+    'your_last_completed': 'complete',
+}
+RECENT_KATAS_LIMIT = 10
+
+
+def build_kata_export_payload(kata, include_user_state=True):
+    payload = {
+        'id': kata.get('id'),
+        'title': kata.get('title'),
+        'content': kata.get('content'),
+        'difficulty': kata.get('difficulty'),
+        'completion_time': kata.get('completion_time'),
+        'topics': kata.get('topics', []),
+        'stats': {
+            'upvotes': kata.get('upvotes'),
+            'saves': kata.get('saves'),
+            'completions': kata.get('completions'),
+        },
+        'author': kata.get('author_display_name'),
+        'created_at': kata.get('created_at'),
+    }
+
+    if include_user_state:
+        note_value = kata.get('user_note') or ''
+        payload['user_state'] = {
+            'is_upvoted': bool(kata.get('is_upvoted')),
+            'is_saved': bool(kata.get('is_saved')),
+            'is_completed': bool(kata.get('is_completed')),
+            'note': note_value,
+        }
+    return payload
+
+
+def recent_kata_ids(cursor, user_id, names):
+    """Map each action behind the `names` placeholders to the user's latest kata ids, in one query."""
+    actions = {RECENT_KATA_PLACEHOLDERS[name] for name in names}
+    cursor.execute("""
+        SELECT action_type, kata_id FROM (
+            SELECT uka.action_type, uka.kata_id,
+                   ROW_NUMBER() OVER (PARTITION BY uka.action_type ORDER BY uka.timestamp DESC) AS position
+            FROM user_kata_actions uka
+            WHERE uka.user_id = ? AND uka.action_type IN (SELECT value FROM json_each(?))
+        )
+        WHERE position <= ?
+        ORDER BY action_type, position
+    """, (user_id, json.dumps(sorted(actions)), RECENT_KATAS_LIMIT))
+    ids_by_action = {}
+    for row in cursor.fetchall():
+        ids_by_action.setdefault(row[0], []).append(row[1])
+    return ids_by_action
+
+
+def recent_kata_values(names, ids_by_action, katas_by_id):
+    """The JSON each "recent katas" placeholder expands to, given the hydrated katas by id."""
+    values = {}
+    for name in names:
+        exports = [build_kata_export_payload(katas_by_id[kata_id], include_user_state=True)
+                   for kata_id in ids_by_action.get(RECENT_KATA_PLACEHOLDERS[name], [])
+                   if kata_id in katas_by_id]
+        values[name] = json.dumps(exports, indent=2)
+    return values
+
+
+def compile_prompt_text(prompt_content, user_id, resolve_recent):
+    """Replace the placeholders present in the prompt in a single pass, resolving only those.
+
+    `resolve_recent(names, user_id)` returns the values of the "recent katas" placeholders in `names`.
+    """
+    present = set(PROMPT_PLACEHOLDER_RE.findall(prompt_content))
+    values = {name: PROMPT_PLACEHOLDERS[name](user_id) for name in present if name in PROMPT_PLACEHOLDERS}
+    recent = [name for name in present if name in RECENT_KATA_PLACEHOLDERS]
+    if recent:
+        values.update(resolve_recent(recent, user_id))
+    return PROMPT_PLACEHOLDER_RE.sub(lambda match: values.get(match.group(1), match.group(0)), prompt_content)
@@ -0,0 +1,63 @@
+"""Full-text search over katas: query building, ranking and snippets.
+
+katas_fts is an external-content FTS5 table over katas (see database.py):
+it holds only the index, and reads title/content/topics_text back from
+katas when it needs them (for snippets). Shared by the app and the MCP
+server, so nothing here imports Flask.
+"""
+import json
+import re
+
+from markupsafe import Markup, escape
+
+# bm25() weights for title, content and topics_text: a hit in the title or
+# the topics says far more about a kata than one somewhere in its body
+BM25_WEIGHTS = (10.0, 1.0, 5.0)
+RELEVANCE_SQL = f"bm25(katas_fts, {', '.join(map(str, BM25_WEIGHTS))})"
+SNIPPET_TOKENS = 16
+# Control characters don't occur in real kata text, so they can mark the matches; strays are dropped
+MATCH_START, MATCH_END = '\x02', '\x03'
+SNIPPET_SQL = f"snippet(katas_fts, -1, '{MATCH_START}', '{MATCH_END}', '…', {SNIPPET_TOKENS})"
+
+TERM_RE = re.compile(r'\S+')
+WORD_RE = re.compile(r'\w+')
+HIGHLIGHT_RE = re.compile(f'{MATCH_START}(.*?){MATCH_END}', re.S)
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query: every term must match, the last word of each as a prefix.
+
+    Each whitespace-separated term becomes a quoted phrase of its words, so
+    "q-learning" searches for "q learning" instead of being parsed as FTS5
+    syntax (where it would be a column filter and a syntax error). Returns ''
+    when the text holds no words at all.
+    """
+    phrases = []
+    for term in TERM_RE.findall(text):
+        words = WORD_RE.findall(term)
+        if words:
+            phrases.append('"' + ' '.join(words) + '"*')
+    return ' '.join(phrases)
+
+
+def highlight(snippet):
+    """Escape a snippet() excerpt for HTML, wrapping the matched terms in <mark>."""
+    parts = []
+    position = 0
+    for match in HIGHLIGHT_RE.finditer(snippet):
+        parts.append(escape(snippet[position:match.start()]))
+        parts.append(Markup('<mark>%s</mark>') % match.group(1))
+        position = match.end()
+    parts.append(escape(snippet[position:]))
+    return Markup('').join(parts).replace(MATCH_START, '').replace(MATCH_END, '')
+
+
+def plain(snippet):
+    return snippet.replace(MATCH_START, '').replace(MATCH_END, '')
+
+
+def snippets(cursor, match, kata_ids, render=highlight):
+    """Best-matching excerpt of each kata in `kata_ids` for the FTS query `match`, in one query."""
+    cursor.execute(f"SELECT rowid, {SNIPPET_SQL} FROM katas_fts WHERE katas_fts MATCH ? AND rowid IN (SELECT value FROM json_each(?))",
+                   (match, json.dumps(kata_ids)))
+    return {row[0]: render(row[1]) for row in cursor.fetchall()}
@@ -0,0 +1,216 @@
+"""TF-IDF content similarity between katas with precomputed top-k neighbors.
+
+Each kata is reduced to its MAX_TERMS highest-weighted terms (stored in
+kata_terms) and its SIMILAR_K nearest katas by cosine similarity are kept in
+kata_neighbors, so showing similar katas is a single indexed lookup.
+Submitting or deleting a kata only touches the katas sharing terms with it;
+rebuild() recomputes everything from scratch.
+"""
+import itertools
+import json
+import math
+import re
+from array import array
+from collections import Counter
+
+SIMILAR_K = 5
+MAX_TERMS = 24
+# Terms present in more than this share of katas (and in more than
+# MIN_CANDIDATE_DF of them) are too common to find candidates with
+MAX_DF_RATIO = 0.05
+MIN_CANDIDATE_DF = 100
+# How many of the best-scoring candidates get the new kata merged into their lists
+MAX_UPDATED_NEIGHBORS = 50
+TITLE_WEIGHT = 3
+TOPICS_WEIGHT = 2
+
+TOKEN_RE = re.compile(r'[a-z][a-z0-9]+')
+STOP_WORDS = frozenset('''
+    an and are as at be by can de do each for from has have how if in into is it its of on or such
+    that the their then there these this to use used using was we what when which will with you your
+'''.split())
+
+
+def term_counts(title, content, topics_text):
+    counts = Counter()
+    for text, weight in ((title, TITLE_WEIGHT), (topics_text, TOPICS_WEIGHT), (content, 1)):
+        for token in TOKEN_RE.findall((text or '').lower()):
+            if token not in STOP_WORDS:
+                counts[token] += weight
+    return counts
+
+
+def vectorize(counts, df, doc_count):
+    """Keep the top MAX_TERMS tf-idf weights of a document, L2-normalized."""
+    weights = {}
+    for term, count in counts.items():
+        idf = math.log((doc_count + 1) / (df.get(term, 0) + 1)) + 1
+        weights[term] = (1 + math.log(count)) * idf
+    top = sorted(weights.items(), key=lambda item: item[1], reverse=True)[:MAX_TERMS]
+    norm = math.sqrt(sum(weight * weight for _, weight in top)) or 1.0
+    return {term: weight / norm for term, weight in top}
+
+
+def _fetch_document_frequencies(cursor, terms):
+    cursor.execute("SELECT term, df FROM similar_terms WHERE term IN (SELECT value FROM json_each(?))", (json.dumps(list(terms)),))
+    return {row[0]: row[1] for row in cursor.fetchall()}
+
+
+def _doc_count(cursor):
+    cursor.execute("SELECT COUNT(*) FROM katas")
+    return cursor.fetchone()[0]
+
+
+def _score_candidates(cursor, kata_id, vector, doc_count, df):
+    """Cosine similarity of `vector` against every kata sharing a selective term with it."""
+    max_df = max(MIN_CANDIDATE_DF, int(doc_count * MAX_DF_RATIO))
+    terms = [term for term in vector if df.get(term, 0) <= max_df]
+    scores = {}
+    if terms:
+        cursor.execute("SELECT kata_id, term, weight FROM kata_terms WHERE term IN (SELECT value FROM json_each(?)) AND kata_id != ?",
+                       (json.dumps(terms), kata_id))
+        for other_id, term, weight in cursor.fetchall():
+            scores[other_id] = scores.get(other_id, 0.0) + vector[term] * weight
+    return scores
+
+
+def _top_k(scores):
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:SIMILAR_K]
+
+
+def _write_neighbors(cursor, kata_id, neighbors):
+    cursor.execute("DELETE FROM kata_neighbors WHERE kata_id = ?", (kata_id,))
+    cursor.executemany("INSERT INTO kata_neighbors (kata_id, rank, neighbor_id, score) VALUES (?, ?, ?, ?)",
+                       [(kata_id, rank, neighbor_id, score) for rank, (neighbor_id, score) in enumerate(neighbors)])
+
+
+def _recompute_neighbors(cursor, kata_id, doc_count):
+    cursor.execute("SELECT term, weight FROM kata_terms WHERE kata_id = ?", (kata_id,))
+    vector = {row[0]: row[1] for row in cursor.fetchall()}
+    df = _fetch_document_frequencies(cursor, vector)
+    _write_neighbors(cursor, kata_id, _top_k(_score_candidates(cursor, kata_id, vector, doc_count, df)))
+
+
+def add_katas(db, kata_ids):
+    """Index newly inserted katas and merge them into their neighbors' top-k lists.
+
+    Runs in the caller's transaction; the caller commits.
+    """
+    cursor = db.cursor()
+    cursor.execute("SELECT id, title, content, topics_text FROM katas WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(list(kata_ids)),))
+    rows = cursor.fetchall()
+    doc_count = _doc_count(cursor)
+    for row in rows:
+        kata_id = row[0]
+        counts = term_counts(row[1], row[2], row[3])
+        cursor.executemany("INSERT INTO similar_terms (term, df) VALUES (?, 1) ON CONFLICT(term) DO UPDATE SET df = df + 1",
+                           [(term,) for term in counts])
+        df = _fetch_document_frequencies(cursor, counts)
+        vector = vectorize(counts, df, doc_count)
+        cursor.execute("DELETE FROM kata_terms WHERE kata_id = ?", (kata_id,))
+        cursor.executemany("INSERT INTO kata_terms (kata_id, term, weight) VALUES (?, ?, ?)",
+                           [(kata_id, term, weight) for term, weight in vector.items()])
+
+        scores = _score_candidates(cursor, kata_id, vector, doc_count, df)
+        _write_neighbors(cursor, kata_id, _top_k(scores))
+
+        # Similarity is symmetric: the new kata may now belong in the candidates' lists too
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:MAX_UPDATED_NEIGHBORS]
+        if not best:
+            continue
+        cursor.execute("SELECT kata_id, neighbor_id, score FROM kata_neighbors WHERE kata_id IN (SELECT value FROM json_each(?))",
+                       (json.dumps([other_id for other_id, _ in best]),))
+        current = {}
+        for other_id, neighbor_id, score in cursor.fetchall():
+            current.setdefault(other_id, {})[neighbor_id] = score
+        for other_id, score in best:
+            neighbors = current.get(other_id, {})
+            if len(neighbors) < SIMILAR_K or score > min(neighbors.values()):
+                neighbors[kata_id] = score
+                _write_neighbors(cursor, other_id, _top_k(neighbors))
+
+
+def remove_kata(db, kata_id):
+    """Drop a kata from the index; call before its katas row is deleted, in the same transaction."""
+    cursor = db.cursor()
+    cursor.execute("SELECT title, content, topics_text FROM katas WHERE id = ?", (kata_id,))
+    row = cursor.fetchone()
+    if row is not None:
+        cursor.executemany("UPDATE similar_terms SET df = df - 1 WHERE term = ?",
+                           [(term,) for term in term_counts(row[0], row[1], row[2])])
+    cursor.execute("DELETE FROM kata_terms WHERE kata_id = ?", (kata_id,))
+    cursor.execute("DELETE FROM kata_neighbors WHERE kata_id = ?", (kata_id,))
+    cursor.execute("SELECT DISTINCT kata_id FROM kata_neighbors WHERE neighbor_id = ?", (kata_id,))
+    affected = [r[0] for r in cursor.fetchall()]
+    doc_count = _doc_count(cursor) - 1
+    for other_id in affected:
+        _recompute_neighbors(cursor, other_id, doc_count)
+
+
+def get_similar_katas(db, kata_id):
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT k.id, k.title, n.score
+        FROM kata_neighbors n JOIN katas k ON k.id = n.neighbor_id
+        WHERE n.kata_id = ?
+        ORDER BY n.rank
+    """, (kata_id,))
+    return cursor.fetchall()
+
+
+def rebuild(db, log=print):
+    """Recompute term statistics, vectors and neighbor lists for the whole corpus."""
+    cursor = db.cursor()
+
+    # Pass 1: document frequencies, streaming over the corpus
+    df = Counter()
+    doc_count = 0
+    cursor.execute("SELECT title, content, topics_text FROM katas")
+    for row in cursor:
+        df.update(term_counts(row[0], row[1], row[2]).keys())
+        doc_count += 1
+    log(f"Counted {len(df)} terms over {doc_count} katas.")
+
+    # Pass 2: vectors, kept as compact per-term postings for the scoring pass
+    write_cursor = db.cursor()
+    write_cursor.execute("DELETE FROM similar_terms")
+    write_cursor.executemany("INSERT INTO similar_terms (term, df) VALUES (?, ?)", df.items())
+    write_cursor.execute("DELETE FROM kata_terms")
+    postings = {}
+    max_df = max(MIN_CANDIDATE_DF, int(doc_count * MAX_DF_RATIO))
+    cursor.execute("SELECT id, title, content, topics_text FROM katas")
+    for row in cursor:
+        vector = vectorize(term_counts(row[1], row[2], row[3]), df, doc_count)
+        write_cursor.executemany("INSERT INTO kata_terms (kata_id, term, weight) VALUES (?, ?, ?)",
+                                 [(row[0], term, weight) for term, weight in vector.items()])
+        for term, weight in vector.items():
+            if df[term] <= max_df:
+                ids, weights = postings.setdefault(term, (array('q'), array('d')))
+                ids.append(row[0])
+                weights.append(weight)
+    del df
+    log("Built vectors.")
+
+    # Pass 3: top-k neighbors via the inverted index, reading the vectors back in id order
+    write_cursor.execute("DELETE FROM kata_neighbors")
+    batch = []
+    cursor.execute("SELECT kata_id, term, weight FROM kata_terms ORDER BY kata_id")
+    for done, (kata_id, terms) in enumerate(itertools.groupby(cursor, key=lambda row: row[0]), start=1):
+        vector = {row[1]: row[2] for row in terms}
+        scores = {}
+        for term, weight in vector.items():
+            posting = postings.get(term)
+            if posting is None:
+                continue
+            for other_id, other_weight in zip(*posting):
+                if other_id != kata_id:
+                    scores[other_id] = scores.get(other_id, 0.0) + weight * other_weight
+        batch.extend((kata_id, rank, neighbor_id, score) for rank, (neighbor_id, score) in enumerate(_top_k(scores)))
+        if len(batch) >= 10000:
+            write_cursor.executemany("INSERT INTO kata_neighbors (kata_id, rank, neighbor_id, score) VALUES (?, ?, ?, ?)", batch)
+            batch = []
+        if done % 10000 == 0:
+            log(f"Neighbors computed for {done}/{doc_count} katas.")
+    write_cursor.executemany("INSERT INTO kata_neighbors (kata_id, rank, neighbor_id, score) VALUES (?, ?, ?, ?)", batch)
+    db.commit()
+    log(f"Rebuilt similar katas for {doc_count} katas.")
@@ -3,19 +3,52 @@ document.addEventListener('DOMContentLoaded', () => {
     const searchForm = document.querySelector('.search-form');
     let autocompleteWrapper;
 
-    searchInput.addEventListener('input', async (e) => {
-        const query = e.target.value;
+    const DEBOUNCE_MS = 150;
+    const responseCache = new Map(); // query -> suggestions, kept for the page's lifetime
+    let debounceTimer;
+    let inFlight;
+
+    async function fetchSuggestions(query) {
+        if (responseCache.has(query)) {
+            return responseCache.get(query);
+        }
+        if (inFlight) {
+            inFlight.abort();
+        }
+        inFlight = new AbortController();
+        const response = await fetch(`/autocomplete?query=${encodeURIComponent(query)}`, { signal: inFlight.signal });
+        const data = await response.json();
+        responseCache.set(query, data);
+        return data;
+    }
 
+    searchInput.addEventListener('input', (e) => {
+        clearTimeout(debounceTimer);
+        debounceTimer = setTimeout(() => showSuggestions(e.target.value), DEBOUNCE_MS);
+    });
+
+    async function showSuggestions(query) {
         if (autocompleteWrapper) {
             autocompleteWrapper.remove();
+            autocompleteWrapper = null;
         }
 
         if (query.length < 2) {
             return;
         }
 
-        const response = await fetch(`/autocomplete?query=${query}`);
-        const data = await response.json();
+        let data;
+        try {
+            data = await fetchSuggestions(query);
+        } catch (err) {
+            if (err.name === 'AbortError') return;
+            throw err;
+        }
+
+        // Ignore answers for a query the user has already typed past
+        if (query !== searchInput.value) {
+            return;
+        }
 
         if (data.titles.length === 0 && data.topics.length === 0) {
             return;
@@ -26,7 +59,7 @@ document.addEventListener('DOMContentLoaded', () => {
         searchForm.appendChild(autocompleteWrapper);
 
         const fullTextSearch = document.createElement('a');
-        fullTextSearch.href = `/?search=${query}`;
+        fullTextSearch.href = `/?search=${encodeURIComponent(query)}`;
         fullTextSearch.innerHTML = `Perform full text search for '<strong>${query}</strong>'`;
         fullTextSearch.className = 'autocomplete-item';
         autocompleteWrapper.appendChild(fullTextSearch);
@@ -54,13 +87,13 @@ document.addEventListener('DOMContentLoaded', () => {
 
             data.topics.forEach(topic => {
                 const item = document.createElement('a');
-                item.href = `/?topic=${topic}`;
+                item.href = `/?topic=${encodeURIComponent(topic)}`;
                 item.textContent = topic;
                 item.className = 'autocomplete-item';
                 autocompleteWrapper.appendChild(item);
             });
         }
-    });
+    }
 
     document.addEventListener('click', (e) => {
         if (autocompleteWrapper && !searchForm.contains(e.target)) {
@@ -0,0 +1,230 @@
+import bisect
+import re
+import threading
+import time
+
+from database import connect
+
+WORD_RE = re.compile(r'\w+')
+
+# How often a worker looks for katas/topics added by other processes, and how
+# often it rebuilds from scratch to drop ones they deleted
+REFRESH_INTERVAL = 5
+REBUILD_INTERVAL = 600
+# Upper bound on candidates scored per lookup, so one-letter prefixes stay cheap
+CANDIDATE_LIMIT = 1000
+
+
+def tokenize(text):
+    return WORD_RE.findall(text.lower())
+
+
+class PrefixIndex:
+    """Maps every word of an entry's text to the entry, searchable by word prefix."""
+
+    def __init__(self):
+        self.vocabulary = []  # sorted distinct words
+        self.postings = {}    # word -> set of entry keys
+        self.entries = {}     # entry key -> (text, score)
+
+    def add(self, key, text, score=0):
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (text, score)
+        for word in set(tokenize(text)):
+            keys = self.postings.get(word)
+            if keys is None:
+                keys = self.postings[word] = set()
+                bisect.insort(self.vocabulary, word)
+            keys.add(key)
+
+    def add_many(self, items):
+        """Add (key, text, score) items, sorting the vocabulary once instead of inserting word by word."""
+        items = list(items)
+        for key, _, _ in items:
+            self.remove(key)
+        new_words = []
+        for key, text, score in items:
+            self.entries[key] = (text, score)
+            for word in set(tokenize(text)):
+                keys = self.postings.get(word)
+                if keys is None:
+                    keys = self.postings[word] = set()
+                    new_words.append(word)
+                keys.add(key)
+        if new_words:
+            self.vocabulary += new_words
+            self.vocabulary.sort()
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for word in set(tokenize(entry[0])):
+            keys = self.postings.get(word)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self.postings[word]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, word)]
+
+    def bump(self, key, text, delta):
+        if key in self.entries:
+            text, score = self.entries[key]
+            self.entries[key] = (text, score + delta)
+        else:
+            self.add(key, text, delta)
+
+    def _prefix_matches(self, prefix):
+        matches = set()
+        i = bisect.bisect_left(self.vocabulary, prefix)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(prefix):
+            matches |= self.postings[self.vocabulary[i]]
+            if len(matches) >= CANDIDATE_LIMIT:
+                break
+            i += 1
+        return matches
+
+    def search(self, query, limit):
+        words = tokenize(query)
+        if not words:
+            return []
+        # Every query word must prefix-match some word of the entry
+        candidates = None
+        for word in sorted(words, key=len, reverse=True):
+            matches = self._prefix_matches(word)
+            candidates = matches if candidates is None else candidates & matches
+            if not candidates:
+                return []
+
+        query = query.strip().lower()
+
+        def rank(key):
+            text, score = self.entries[key]
+            return (not text.lower().startswith(query), -score, len(text), text)
+
+        return sorted(candidates, key=rank)[:limit]
+
+
+class SuggestionIndex:
+    """Kata titles and topic names for /autocomplete, kept in memory per process."""
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._titles = PrefixIndex()
+        self._topics = PrefixIndex()
+        self._max_kata_id = 0
+        self._max_topic_id = 0
+        self._refreshed_at = 0
+        self._rebuilt_at = 0
+        # Set while a rebuild runs; katas removed meanwhile are dropped from its result
+        self._rebuilding = False
+        self._removed_during_rebuild = set()
+
+    def add_kata(self, kata_id, title, score=0):
+        with self._lock:
+            self._titles.add(kata_id, title, score)
+
+    def remove_kata(self, kata_id):
+        with self._lock:
+            self._titles.remove(kata_id)
+            if self._rebuilding:
+                self._removed_during_rebuild.add(kata_id)
+
+    def add_topic(self, name, delta=1):
+        with self._lock:
+            self._topics.bump(name, name, delta)
+
+    def search(self, query, title_limit=7, topic_limit=5):
+        with self._lock:
+            titles = [{'id': kata_id, 'title': self._titles.entries[kata_id][0]}
+                      for kata_id in self._titles.search(query, title_limit)]
+            topics = self._topics.search(query, topic_limit)
+        return titles, topics
+
+    def sync(self, db):
+        """Bring the index up to date with the database if it is due.
+
+        Only the first load happens in the request, as there is nothing to
+        serve before it (wsgi.py does it before the workers fork). Periodic
+        rebuilds run in a background thread while the old indexes keep
+        answering.
+        """
+        now = time.monotonic()
+        if not self._refreshed_at:
+            self.rebuild(db)
+        elif now - self._rebuilt_at >= REBUILD_INTERVAL:
+            if self._claim_rebuild():
+                threading.Thread(target=self._rebuild_in_background, name='suggestions-rebuild', daemon=True).start()
+        elif now - self._refreshed_at >= REFRESH_INTERVAL:
+            self._load(db, self._max_kata_id, self._max_topic_id)
+
+    def _claim_rebuild(self):
+        # Marks the rebuild as started, so concurrent requests (and, should it fail, the next
+        # REBUILD_INTERVAL of them) don't start another
+        with self._lock:
+            if self._rebuilding:
+                return False
+            self._rebuilding = True
+            self._rebuilt_at = time.monotonic()
+            return True
+
+    def rebuild(self, db):
+        """Reload everything from the database, unless another thread already is."""
+        if self._claim_rebuild():
+            self._rebuild(db)
+
+    def _rebuild_in_background(self):
+        db = self._connect()
+        try:
+            self._rebuild(db)
+        except Exception as exc:
+            print(f"Suggestion index rebuild failed: {exc!r}")
+        finally:
+            db.close()
+
+    def _rebuild(self, db):
+        # Built off to the side and swapped in complete, so lookups never see a partial index
+        try:
+            katas, topics = self._fetch(db, 0, 0)
+            titles_index, topics_index = PrefixIndex(), PrefixIndex()
+            titles_index.add_many((row['id'], row['title'], row['upvotes'] or 0) for row in katas)
+            topics_index.add_many((row['name'], row['name'], row['kata_count']) for row in topics)
+            with self._lock:
+                for kata_id in self._removed_during_rebuild:
+                    titles_index.remove(kata_id)
+                self._titles, self._topics = titles_index, topics_index
+                # Katas added meanwhile have higher ids, so the next refresh picks them up
+                self._max_kata_id = max((row['id'] for row in katas), default=0)
+                self._max_topic_id = max((row['id'] for row in topics), default=0)
+                self._refreshed_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._rebuilding = False
+                self._removed_during_rebuild = set()
+
+    def _fetch(self, db, after_kata_id, after_topic_id):
+        cursor = db.cursor()
+        cursor.execute("SELECT id, title, upvotes FROM katas WHERE id > ?", (after_kata_id,))
+        katas = cursor.fetchall()
+        cursor.execute("""
+            SELECT t.id, t.name, COUNT(kt.kata_id) AS kata_count
+            FROM topics t LEFT JOIN kata_topics kt ON kt.topic_id = t.id
+            WHERE t.id > ?
+            GROUP BY t.id
+        """, (after_topic_id,))
+        return katas, cursor.fetchall()
+
+    def _load(self, db, after_kata_id, after_topic_id):
+        katas, topics = self._fetch(db, after_kata_id, after_topic_id)
+        with self._lock:
+            self._titles.add_many((row['id'], row['title'], row['upvotes'] or 0) for row in katas)
+            self._topics.add_many((row['name'], row['name'], row['kata_count']) for row in topics)
+            self._max_kata_id = max([self._max_kata_id] + [row['id'] for row in katas])
+            self._max_topic_id = max([self._max_topic_id] + [row['id'] for row in topics])
+            self._refreshed_at = time.monotonic()
+
+
+suggestions = SuggestionIndex(connect)
@@ -0,0 +1,38 @@
+"""Production entry point for a pre-forking server.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+gunicorn.conf.py sets preload_app, so the master imports this module once:
+the schema is brought up to date (app.py runs init_db()), every template is
+compiled, the markdown renderer is loaded and the autocomplete index is built
+before any worker forks. Each worker, including the ones that replace
+recycled workers, then starts with all of it already in memory instead of
+paying for it on its first requests.
+"""
+import time
+
+_started = time.perf_counter()
+
+from app import app, render_kata_html  # noqa: E402
+from database import connect  # noqa: E402
+from suggest import suggestions  # noqa: E402
+
+
+def warm_up():
+    # Compile the URL matcher, otherwise built on each worker's first request
+    app.url_map.update()
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+    # Imports markdown2 and its LaTeX extra
+    render_kata_html("Warm up `code` and $$x^2$$")
+    # On a connection of its own, closed again: the master must not hold a
+    # SQLite handle (pooled or not) across the fork
+    db = connect()
+    try:
+        suggestions.sync(db)
+    finally:
+        db.close()
+
+
+warm_up()
+STARTUP_SECONDS = time.perf_counter() - _started